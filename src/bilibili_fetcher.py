@@ -4,16 +4,26 @@ import httpx
 import os
 import re
 import httpx
+import asyncio
 import logging
-from typing import Optional, Literal
+import time
+from typing import Optional, Literal, Union, Dict, Any, List, Tuple
 from urllib.parse import urlparse, parse_qs
 
 from bilibili_api import video, Credential
 from bilibili_api.utils.network import ResponseCodeException
 
+from .caption_compactor import compact_segments
+from .caption_cache import cache_get, cache_set, restamp_if_unchanged, is_stale, is_body_expired, begin_refresh, end_refresh, content_version
+from .timings import RequestTimings
+from .caption_chunker import get_or_build_chunks, DEFAULT_CHUNK_BUDGET, BudgetUnit
+
 # Get module-level logger
 logger = logging.getLogger(__name__)
 
+# Keep references to background refresh tasks so they aren't garbage collected mid-flight
+_background_tasks: set[asyncio.Task] = set()
+
 # Helper function to parse Bilibili URL
 def parse_bilibili_url(url: str) -> tuple[Optional[str], Optional[int]]:
     """
@@ -45,208 +55,411 @@ def parse_bilibili_url(url: str) -> tuple[Optional[str], Optional[int]]:
 
     return bvid, page
 
-async def fetch_bilibili_subtitle(
-    url: str,
-    credential: Optional[Credential] = None,
-    preferred_lang: str = "zh-CN",
-    output_format: Literal["text", "timestamped"] = "text",
-) -> str:
+def _body_to_segments(body: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Bilibili items use 'from'/'to'/'content'; the compactor and chunker use 'start'/'end'/'text'
+    return [
+        {"start": item.get("from", 0.0), "end": item.get("to", 0.0), "text": item.get("content", "")}
+        for item in body
+    ]
+
+def _format_subtitle_body(
+    entry: Dict[str, Any],
+    cache_key: str,
+    output_format: Literal["text", "timestamped"],
+    output_options: Dict[str, Any],
+) -> Union[str, Dict[str, Any]]:
     """
-    Fetches subtitles for a given Bilibili video URL.
-
-    :param url: The URL of the Bilibili video (e.g., "https://www.bilibili.com/video/BV1fz4y1j7Mf/?p=2").
-    :param credential: Bilibili Credential object. Can be None if not needed for public videos.
-    :param preferred_lang: The preferred subtitle language code (e.g., 'zh-CN', 'ai-zh', 'en'). Defaults to 'zh-CN'.
-                           Check the video page for available languages. 'ai-zh' is often AI-generated Chinese.
-    :param output_format: The desired format for the subtitles ('text' for plain text, 'timestamped' for text with timestamps). Defaults to 'text'.
-    :return: The formatted subtitle string, or an error message.
+    Formats a cached Bilibili subtitle entry, whose body is a list of items with 'from', 'to' and
+    'content' keys, optionally compacting it first. In 'chunks' output mode the body is returned as
+    token-budgeted chunks instead, and `output_format` is ignored since every chunk carries its timestamps.
     """
-    logger.info(
-        f"Received request for URL: {url}, lang: {preferred_lang}, format: {output_format}"
-    )
-
-    bvid, page = parse_bilibili_url(url)
-
-    if not bvid:
-        error_msg = f"Error: Could not extract a valid bvid from the URL: {url}"
-        logger.error(error_msg)
-        return error_msg
-
-    logger.info(f"Parsed bvid: {bvid}, page: {page}")
-
-    try:
-        # Check for sessdata in environment variables
-        env_sessdata = os.environ.get("SESSDATA")
-        env_bili_jct = os.environ.get("BILI_JCT")
-        env_buvid3 = os.environ.get("BUVID3")
-
-        determined_credential = credential # Start with the passed credential
-
-        if env_sessdata:
-            logger.info("Using sessdata from environment variable SESSDATA")
-            # Prioritize environment variables if sessdata is provided
-            determined_credential = Credential(
-                sessdata=env_sessdata,
-                bili_jct=env_bili_jct,
-                buvid3=env_buvid3
+    body = entry["body"]
+    compact = output_options.get("compact", False)
+
+    if output_options.get("output_mode") == "chunks":
+        budget = output_options.get("chunk_budget", DEFAULT_CHUNK_BUDGET)
+        unit = output_options.get("budget_unit", "tokens")
+        chunks, stats = get_or_build_chunks(
+            cache_key, entry.get("version"), _body_to_segments(body), budget, unit, compact
+        )
+        response: Dict[str, Any] = {"chunks": chunks}
+        if stats is not None:
+            response["compaction"] = stats
+        return response
+
+    compaction_stats: Optional[Dict[str, Any]] = None
+    if compact:
+        compacted, compaction_stats = compact_segments(_body_to_segments(body))
+        body = [
+            {"from": segment["start"], "to": segment["end"], "content": segment["text"]}
+            for segment in compacted
+        ]
+
+    formatted_subtitle = ""
+    if output_format == "timestamped":
+        for item in body:
+            start = item.get("from", 0.0)
+            end = item.get("to", 0.0)
+            content = item.get("content", "")
+            # Simple timestamp format HH:MM:SS.ms
+            start_h, start_rem = divmod(start, 3600)
+            start_m, start_s = divmod(start_rem, 60)
+            start_ms = int((start_s - int(start_s)) * 1000)
+
+            end_h, end_rem = divmod(end, 3600)
+            end_m, end_s = divmod(end_rem, 60)
+            end_ms = int((end_s - int(end_s)) * 1000)
+
+            formatted_subtitle += f"{int(start_h):02}:{int(start_m):02}:{int(start_s):02}.{start_ms:03} --> "
+            formatted_subtitle += (
+                f"{int(end_h):02}:{int(end_m):02}:{int(end_s):02}.{end_ms:03}\n"
             )
-        elif (env_bili_jct or env_buvid3):
-             logger.warning("SESSDATA environment variable is not set, but BILI_JCT or BUVID3 are. SESSDATA is required for credential.")
+            formatted_subtitle += f"{content}\n\n"
+        logger.info("Formatted subtitles with timestamps.")
+    else:  # Default to plain text
+        lines = [item.get("content", "") for item in body]
+        formatted_subtitle = "\n".join(lines)
+        logger.info("Formatted subtitles as plain text.")
+
+    if compaction_stats is not None:
+        return {"captions": formatted_subtitle.strip(), "compaction": compaction_stats}
+    return formatted_subtitle.strip()
+
+async def _fetch_subtitle_body(
+    bvid: str,
+    page: Optional[int],
+    preferred_lang: str,
+    credential: Optional[Credential],
+    cache_key: str,
+    timings: RequestTimings,
+    cached: Optional[Dict[str, Any]] = None,
+) -> Union[str, Dict[str, Any]]:
+    """
+    Fetches the subtitle body for a video part and stores it in the caption cache.
+    When a previously cached entry is given, the track metadata is compared first and the
+    body download is made conditional, so unchanged subtitles are only revalidated.
+
+    :return: The cache entry, whose 'body' is a list of items with 'from', 'to' and 'content' keys,
+             or an error/info message.
+    """
+    # Check for sessdata in environment variables
+    env_sessdata = os.environ.get("SESSDATA")
+    env_bili_jct = os.environ.get("BILI_JCT")
+    env_buvid3 = os.environ.get("BUVID3")
+
+    determined_credential = credential # Start with the passed credential
+
+    if env_sessdata:
+        logger.info("Using sessdata from environment variable SESSDATA")
+        # Prioritize environment variables if sessdata is provided
+        determined_credential = Credential(
+            sessdata=env_sessdata,
+            bili_jct=env_bili_jct,
+            buvid3=env_buvid3
+        )
+    elif (env_bili_jct or env_buvid3):
+         logger.warning("SESSDATA environment variable is not set, but BILI_JCT or BUVID3 are. SESSDATA is required for credential.")
 
 
-        v = video.Video(bvid=bvid, credential=determined_credential)
+    v = video.Video(bvid=bvid, credential=determined_credential)
 
-        # Get video info to find the correct cid
+    # Get video info to find the correct cid
+    with timings.stage("video_info"):
         info = await v.get_info()
-        logger.debug(f"Video info fetched for {bvid}")
-
-        cid: Optional[int] = None
-        # Check if 'pages' key exists and is a list before accessing it
-        pages_info = info.get("pages")
-        if page and isinstance(pages_info, list) and len(pages_info) >= page:
-            # Check if page number is valid (page is 1-based index)
-            if 0 < page <= len(pages_info):
-                cid = pages_info[page - 1].get("cid")  # Use .get for safety
-                if cid:
-                    logger.info(f"Found cid {cid} for page {page}")
-                else:
-                     logger.warning(
-                        f"Page {page} found in 'pages' list, but 'cid' key is missing for that page."
-                    )
-                     # Fallback to default cid if specific page cid is missing
-                     cid = info.get("cid")
+    logger.debug(f"Video info fetched for {bvid}")
+
+    cid: Optional[int] = None
+    # Check if 'pages' key exists and is a list before accessing it
+    pages_info = info.get("pages")
+    if page and isinstance(pages_info, list) and len(pages_info) >= page:
+        # Check if page number is valid (page is 1-based index)
+        if 0 < page <= len(pages_info):
+            cid = pages_info[page - 1].get("cid")  # Use .get for safety
+            if cid:
+                logger.info(f"Found cid {cid} for page {page}")
             else:
-                logger.warning(
-                    f"Invalid page number {page} for video with {len(pages_info)} pages. Falling back to default page."
+                 logger.warning(
+                    f"Page {page} found in 'pages' list, but 'cid' key is missing for that page."
                 )
-                cid = info.get(
-                    "cid"
-                )  # Fallback to the default cid if page is out of range
+                 # Fallback to default cid if specific page cid is missing
+                 cid = info.get("cid")
         else:
-            if page:
-                logger.warning(
-                    f"Page {page} requested but video seems to be single-part or page info missing/invalid. Using default cid."
-                )
+            logger.warning(
+                f"Invalid page number {page} for video with {len(pages_info)} pages. Falling back to default page."
+            )
             cid = info.get(
                 "cid"
-            )  # Default cid for single-part videos or if page not specified/found
-            if cid:
-                logger.info(f"Using default cid {cid}")
+            )  # Fallback to the default cid if page is out of range
+    else:
+        if page:
+            logger.warning(
+                f"Page {page} requested but video seems to be single-part or page info missing/invalid. Using default cid."
+            )
+        cid = info.get(
+            "cid"
+        )  # Default cid for single-part videos or if page not specified/found
+        if cid:
+            logger.info(f"Using default cid {cid}")
 
 
-        if not cid:
-            error_msg = "Error: Could not determine the video part (CID)."
-            logger.error(error_msg)
-            return error_msg
+    if not cid:
+        error_msg = "Error: Could not determine the video part (CID)."
+        logger.error(error_msg)
+        return error_msg
 
-        # Get available subtitles metadata
+    # Get available subtitles metadata
+    with timings.stage("subtitle_metadata"):
         subtitle_info = await v.get_subtitle(cid=cid)
-        logger.debug(f"Subtitle metadata fetched: {subtitle_info}")
-
-        available_subtitles = subtitle_info.get("subtitles", [])
-        if not available_subtitles:
-            info_msg = "Info: No subtitles found for this video part. This might be due to invalid or expired Bilibili credentials. Please check your SESSDATA and BILI_JCT environment variables."
-            logger.warning(info_msg)
-            return info_msg
-
-        # Find the preferred subtitle URL
-        subtitle_url: Optional[str] = None
-        found_lang: Optional[str] = None
+    logger.debug(f"Subtitle metadata fetched: {subtitle_info}")
+
+    available_subtitles = subtitle_info.get("subtitles", [])
+    if not available_subtitles:
+        info_msg = "Info: No subtitles found for this video part. This might be due to invalid or expired Bilibili credentials. Please check your SESSDATA and BILI_JCT environment variables."
+        logger.warning(info_msg)
+        return info_msg
+
+    # Find the preferred subtitle URL
+    subtitle_url: Optional[str] = None
+    found_lang: Optional[str] = None
+    track_id: Optional[str] = None
+
+    # Prioritize exact match for preferred language
+    for sub in available_subtitles:
+        if sub.get("lan") == preferred_lang:
+            subtitle_url = sub.get("subtitle_url")
+            found_lang = sub.get("lan")
+            track_id = str(sub.get("id_str") or sub.get("id") or "")
+            logger.info(f"Found exact match for preferred language: {found_lang}")
+            break
 
-        # Prioritize exact match for preferred language
+    # If exact match not found, try finding *any* subtitle (prioritizing non-AI)
+    if not subtitle_url:
+        logger.warning(
+            f"Preferred language '{preferred_lang}' not found. Searching for alternatives."
+        )
+        # Try non-AI first
         for sub in available_subtitles:
-            if sub.get("lan") == preferred_lang:
+            # Check if 'ai_type' exists and is 0 (manual/official) or if 'ai_type' doesn't exist
+            is_manual = sub.get("ai_type", 0) == 0
+            if is_manual:
                 subtitle_url = sub.get("subtitle_url")
                 found_lang = sub.get("lan")
-                logger.info(f"Found exact match for preferred language: {found_lang}")
+                track_id = str(sub.get("id_str") or sub.get("id") or "")
+                logger.info(f"Found alternative non-AI subtitle: {found_lang}")
                 break
+        # If still no subtitle found, take the first available AI one
+        if not subtitle_url and available_subtitles:
+            subtitle_url = available_subtitles[0].get("subtitle_url")
+            found_lang = available_subtitles[0].get("lan")
+            track_id = str(available_subtitles[0].get("id_str") or available_subtitles[0].get("id") or "")
+            logger.info(f"Found first available AI subtitle: {found_lang}")
 
-        # If exact match not found, try finding *any* subtitle (prioritizing non-AI)
-        if not subtitle_url:
-            logger.warning(
-                f"Preferred language '{preferred_lang}' not found. Searching for alternatives."
-            )
-            # Try non-AI first
-            for sub in available_subtitles:
-                # Check if 'ai_type' exists and is 0 (manual/official) or if 'ai_type' doesn't exist
-                is_manual = sub.get("ai_type", 0) == 0
-                if is_manual:
-                    subtitle_url = sub.get("subtitle_url")
-                    found_lang = sub.get("lan")
-                    logger.info(f"Found alternative non-AI subtitle: {found_lang}")
-                    break
-            # If still no subtitle found, take the first available AI one
-            if not subtitle_url and available_subtitles:
-                subtitle_url = available_subtitles[0].get("subtitle_url")
-                found_lang = available_subtitles[0].get("lan")
-                logger.info(f"Found first available AI subtitle: {found_lang}")
-
-
-        if not subtitle_url:
-            error_msg = "Error: Could not find any subtitle URL."
-            logger.error(error_msg)
-            return error_msg
-
-        # Ensure URL starts with http: or https:
-        if subtitle_url.startswith("//"):
-            subtitle_url = "https:" + subtitle_url
-        elif not subtitle_url.startswith(("http:", "https:")):
-            error_msg = f"Error: Invalid subtitle URL format: {subtitle_url}"
-            logger.error(error_msg)
-            return error_msg
-
-        logger.info(
-            f"Fetching subtitle content from: {subtitle_url} (Language: {found_lang})"
-        )
 
-        # Fetch the actual subtitle JSON content
-        async with httpx.AsyncClient() as client:
-            # Add headers to mimic browser request, might help avoid blocks
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Referer": f"https://www.bilibili.com/video/{bvid}/",  # Add referer
-            }
+    if not subtitle_url:
+        error_msg = "Error: Could not find any subtitle URL."
+        logger.error(error_msg)
+        return error_msg
+
+    # Ensure URL starts with http: or https:
+    if subtitle_url.startswith("//"):
+        subtitle_url = "https:" + subtitle_url
+    elif not subtitle_url.startswith(("http:", "https:")):
+        error_msg = f"Error: Invalid subtitle URL format: {subtitle_url}"
+        logger.error(error_msg)
+        return error_msg
+
+    track = {"id": track_id, "lan": found_lang}
+    conditional_headers: Dict[str, str] = {}
+    if cached is not None and cached.get("track") == track:
+        # Same track as the cached entry, so only ask the server whether the file itself changed
+        validators = cached.get("validators") or {}
+        if validators.get("etag"):
+            conditional_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = validators["last_modified"]
+        if not conditional_headers and not is_body_expired(cached):
+            # Edited subtitles get a new track id, so an unchanged id is enough to keep the body for a TTL
+            logger.info(f"Subtitle track {track_id} for {bvid} unchanged. Keeping cached body.")
+            restamp_if_unchanged(cache_key, cached)
+            return cached
+
+    logger.info(
+        f"Fetching subtitle content from: {subtitle_url} (Language: {found_lang})"
+    )
+
+    # Fetch the actual subtitle JSON content
+    async with httpx.AsyncClient() as client:
+        # Add headers to mimic browser request, might help avoid blocks
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+            "Referer": f"https://www.bilibili.com/video/{bvid}/",  # Add referer
+            **conditional_headers,
+        }
+        with timings.stage("body_download"):
             response = await client.get(
                 subtitle_url, headers=headers, follow_redirects=True
             )
-            response.raise_for_status()  # Raise an exception for bad status codes
+        if response.status_code == 304 and cached is not None:
+            logger.info(f"Subtitle content for {bvid} not modified. Keeping cached body.")
+            restamp_if_unchanged(cache_key, cached)
+            return cached
+        response.raise_for_status()  # Raise an exception for bad status codes
+        with timings.stage("body_parse"):
             subtitle_data = response.json()
-            logger.debug("Subtitle JSON data fetched successfully.")
-
-        # Format the subtitle content
-        body = subtitle_data.get("body", [])
-        if not body:
-            info_msg = "Info: Subtitle file fetched but contains no content."
-            logger.warning(info_msg)
-            return info_msg
-
-        formatted_subtitle = ""
-        if output_format == "timestamped":
-            for item in body:
-                start = item.get("from", 0.0)
-                end = item.get("to", 0.0)
-                content = item.get("content", "")
-                # Simple timestamp format HH:MM:SS.ms
-                start_h, start_rem = divmod(start, 3600)
-                start_m, start_s = divmod(start_rem, 60)
-                start_ms = int((start_s - int(start_s)) * 1000)
-
-                end_h, end_rem = divmod(end, 3600)
-                end_m, end_s = divmod(end_rem, 60)
-                end_ms = int((end_s - int(end_s)) * 1000)
-
-                formatted_subtitle += f"{int(start_h):02}:{int(start_m):02}:{int(start_s):02}.{start_ms:03} --> "
-                formatted_subtitle += (
-                    f"{int(end_h):02}:{int(end_m):02}:{int(end_s):02}.{end_ms:03}\n"
-                )
-                formatted_subtitle += f"{content}\n\n"
-            logger.info("Formatted subtitles with timestamps.")
-        else:  # Default to plain text
-            lines = [item.get("content", "") for item in body]
-            formatted_subtitle = "\n".join(lines)
-            logger.info("Formatted subtitles as plain text.")
-
-        return formatted_subtitle.strip()
+        validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        logger.debug("Subtitle JSON data fetched successfully.")
+
+    # Format the subtitle content
+    body = subtitle_data.get("body", [])
+    if not body:
+        info_msg = "Info: Subtitle file fetched but contains no content."
+        logger.warning(info_msg)
+        return info_msg
+
+    entry = {
+        "body": body,
+        "lang": found_lang,
+        "track": track,
+        "validators": validators,
+        "version": content_version(body),
+        "body_fetched_at": time.time(),
+    }
+    with timings.stage("cache_store"):
+        cache_set(cache_key, entry)
+    return entry
+
+async def _refresh_subtitle(
+    bvid: str,
+    page: Optional[int],
+    preferred_lang: str,
+    credential: Optional[Credential],
+    cache_key: str,
+    cached: Dict[str, Any],
+) -> None:
+    """
+    Revalidates a stale cache entry in the background. Failures keep the stale entry in place
+    and back off further refreshes of the key.
+    """
+    logger.info(f"Revalidating stale subtitle cache entry: {cache_key}")
+    succeeded = False
+    try:
+        result = await _fetch_subtitle_body(
+            bvid, page, preferred_lang, credential, cache_key, RequestTimings(), cached=cached
+        )
+        if isinstance(result, str):
+            logger.warning(f"Background refresh of {cache_key} returned: {result}")
+        else:
+            succeeded = True
+    except Exception as e:
+        logger.warning(f"Background refresh of {cache_key} failed: {type(e).__name__} - {e}")
+    finally:
+        end_refresh(cache_key, failed=not succeeded)
+
+async def fetch_bilibili_subtitle(
+    url: str,
+    credential: Optional[Credential] = None,
+    preferred_lang: str = "zh-CN",
+    output_format: Literal["text", "timestamped"] = "text",
+    compact: bool = False,
+    debug_timings: bool = False,
+    output_mode: Literal["full", "chunks"] = "full",
+    chunk_budget: int = DEFAULT_CHUNK_BUDGET,
+    budget_unit: BudgetUnit = "tokens",
+) -> Union[str, Dict[str, Any]]:
+    """
+    Fetches subtitles for a given Bilibili video URL.
+
+    :param url: The URL of the Bilibili video (e.g., "https://www.bilibili.com/video/BV1fz4y1j7Mf/?p=2").
+    :param credential: Bilibili Credential object. Can be None if not needed for public videos.
+    :param preferred_lang: The preferred subtitle language code (e.g., 'zh-CN', 'ai-zh', 'en'). Defaults to 'zh-CN'.
+                           Check the video page for available languages. 'ai-zh' is often AI-generated Chinese.
+    :param output_format: The desired format for the subtitles ('text' for plain text, 'timestamped' for text with timestamps). Defaults to 'text'.
+    :param compact: If True, deduplicates rolling repeats and merges short segments into sentence-level blocks.
+    :param debug_timings: If True, a per-stage timing breakdown is returned under the 'timings' key.
+    :param output_mode: 'full' returns the formatted subtitles; 'chunks' returns a dictionary with a 'chunks' list,
+                        each chunk fitting `chunk_budget` and carrying its start/end timestamps.
+    :param chunk_budget: The maximum size of a chunk in 'chunks' output mode.
+    :param budget_unit: The unit of `chunk_budget`: 'tokens' (estimated) or 'chars'.
+    :return: The formatted subtitle string, or an error message. With `compact` or `debug_timings`, a dictionary
+             with a 'captions' key (plus 'compaction' and/or 'timings') is returned instead of the plain string;
+             with `debug_timings`, error messages are returned under an 'error' key next to 'timings'.
+    """
+    output_options = {
+        "compact": compact,
+        "output_mode": output_mode,
+        "chunk_budget": chunk_budget,
+        "budget_unit": budget_unit,
+    }
+    timings = RequestTimings()
+    result = await _fetch_bilibili_subtitle(url, credential, preferred_lang, output_format, output_options, timings)
+    if isinstance(result, str):
+        # Error and info messages are never wrapped as captions
+        if debug_timings:
+            return {"error": result, "timings": timings.to_dict()}
+        return result
+
+    entry, cache_key = result
+    with timings.stage("formatting"):
+        response = _format_subtitle_body(entry, cache_key, output_format, output_options)
+    if debug_timings:
+        if isinstance(response, str):
+            response = {"captions": response}
+        response["timings"] = timings.to_dict()
+    return response
+
+async def _fetch_bilibili_subtitle(
+    url: str,
+    credential: Optional[Credential],
+    preferred_lang: str,
+    output_format: Literal["text", "timestamped"],
+    output_options: Dict[str, Any],
+    timings: RequestTimings,
+) -> Union[str, Tuple[Dict[str, Any], str]]:
+    """
+    Implements fetch_bilibili_subtitle up to formatting, recording each stage in `timings`.
+
+    :return: A tuple of the subtitle cache entry and its cache key, or an error or info message.
+    """
+    logger.info(
+        f"Received request for URL: {url}, lang: {preferred_lang}, format: {output_format}"
+    )
+
+    chunk_budget = output_options.get("chunk_budget", DEFAULT_CHUNK_BUDGET)
+    if output_options.get("output_mode") == "chunks" and chunk_budget < 1:
+        error_msg = f"Error: Invalid chunk budget: {chunk_budget}. It must be at least 1."
+        logger.error(error_msg)
+        return error_msg
+
+    with timings.stage("url_parse"):
+        bvid, page = parse_bilibili_url(url)
+
+    if not bvid:
+        error_msg = f"Error: Could not extract a valid bvid from the URL: {url}"
+        logger.error(error_msg)
+        return error_msg
+
+    logger.info(f"Parsed bvid: {bvid}, page: {page}")
+
+    cache_key = f"bilibili:{bvid}:{page or 1}:{preferred_lang}"
+    with timings.stage("cache_lookup"):
+        cached = cache_get(cache_key)
+    if cached is not None:
+        logger.info(f"Serving cached subtitle for bvid: {bvid} (Language: {cached['lang']})")
+        if is_stale(cached) and begin_refresh(cache_key):
+            # Stale-while-revalidate: answer from cache now, revalidate upstream in the background
+            task = asyncio.create_task(_refresh_subtitle(bvid, page, preferred_lang, credential, cache_key, cached))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        return cached, cache_key
+
+    try:
+        entry = await _fetch_subtitle_body(bvid, page, preferred_lang, credential, cache_key, timings)
+        if isinstance(entry, str):
+            return entry
+        return entry, cache_key
 
     except httpx.HTTPStatusError as e:
         error_msg = (
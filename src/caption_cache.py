@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+# Get module-level logger
+logger = logging.getLogger(__name__)
+
+# Constants for cache configuration (overridable via environment variables)
+DEFAULT_CACHE_FRESH_SECONDS = 24 * 3600  # After this, entries are served stale and refreshed in the background
+DEFAULT_CACHE_TTL_SECONDS = 7 * 24 * 3600  # After this, entries are dropped and the next request fetches upstream
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "caption-fetcher-mcp")
+REFRESH_RETRY_SECONDS = 300  # After a failed background refresh, stale hits don't refresh the key again for this long
+DEFAULT_MEMORY_CACHE_MAX_ENTRIES = 1000  # Least recently used entries are evicted beyond this
+DISK_CACHE_PURGE_INTERVAL_SECONDS = 600  # How often a writer deletes expired rows nobody reads again
+REDIS_KEY_PREFIX = "caption-fetcher:"
+
+
+class CaptionCache:
+    """
+    Base class for caption cache backends. Values are JSON-serializable dictionaries,
+    so every backend can be shared between worker processes.
+    """
+
+    def __init__(self, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Dict[str, Any], ttl_seconds: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryCache(CaptionCache):
+    """In-process LRU cache holding at most `max_entries` entries. Only suitable for a single worker."""
+
+    def __init__(self, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS, max_entries: int = DEFAULT_MEMORY_CACHE_MAX_ENTRIES):
+        super().__init__(ttl_seconds)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return json.loads(payload)
+
+    def set(self, key: str, value: Dict[str, Any], ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        # Store the serialized form so callers can't mutate cached entries in place
+        payload = json.dumps(value)
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DiskCache(CaptionCache):
+    """
+    On-host cache backed by a SQLite database in WAL mode, safe to share between
+    the worker processes of a single host.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "captions.sqlite3")
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS captions (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS captions_expires_at ON captions (expires_at)")
+        self._last_purge = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            "SELECT expires_at, value FROM captions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        expires_at, payload = row
+        if expires_at <= time.time():
+            self.delete(key)
+            return None
+        return json.loads(payload)
+
+    def set(self, key: str, value: Dict[str, Any], ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO captions (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, now + ttl, json.dumps(value)),
+            )
+            # Expired rows are otherwise only deleted when their own key is read again
+            if now - self._last_purge >= DISK_CACHE_PURGE_INTERVAL_SECONDS:
+                self._last_purge = now
+                purged = conn.execute("DELETE FROM captions WHERE expires_at <= ?", (now,)).rowcount
+                if purged:
+                    logger.info(f"Purged {purged} expired entries from the disk caption cache.")
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM captions WHERE key = ?", (key,))
+
+
+class RedisCache(CaptionCache):
+    """
+    Cache backed by a Redis-compatible server, shared by every worker and replica.
+    Accepts any client exposing redis-py's get/set(ex=)/delete methods.
+    """
+
+    def __init__(self, client, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS) -> "RedisCache":
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("The 'redis' package is required for CACHE_BACKEND=redis. Install it with: pip install redis") from e
+        return cls(redis.Redis.from_url(url), ttl_seconds=ttl_seconds)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        payload = self.client.get(REDIS_KEY_PREFIX + key)
+        if payload is None:
+            return None
+        return json.loads(payload)
+
+    def set(self, key: str, value: Dict[str, Any], ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self.client.set(REDIS_KEY_PREFIX + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(REDIS_KEY_PREFIX + key)
+
+
+def create_cache_from_env() -> Optional[CaptionCache]:
+    """
+    Creates the cache backend selected by the CACHE_BACKEND environment variable
+    ('memory', 'disk', 'redis' or 'none'). Defaults to 'memory'.
+    """
+    backend = os.environ.get("CACHE_BACKEND", "memory").lower()
+    ttl_seconds = float(os.environ.get("CACHE_TTL_SECONDS", DEFAULT_CACHE_TTL_SECONDS))
+
+    if backend == "none":
+        logger.info("Caption cache disabled.")
+        return None
+    if backend == "disk":
+        cache_dir = os.environ.get("CACHE_DIR", DEFAULT_CACHE_DIR)
+        logger.info(f"Using disk caption cache in {cache_dir}")
+        return DiskCache(cache_dir, ttl_seconds=ttl_seconds)
+    if backend == "redis":
+        redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+        logger.info(f"Using Redis caption cache at {redis_url}")
+        return RedisCache.from_url(redis_url, ttl_seconds=ttl_seconds)
+    if backend != "memory":
+        logger.warning(f"Unknown CACHE_BACKEND '{backend}'. Falling back to in-memory cache.")
+    max_entries = int(os.environ.get("CACHE_MAX_ENTRIES", DEFAULT_MEMORY_CACHE_MAX_ENTRIES))
+    logger.info(f"Using in-memory caption cache (up to {max_entries} entries).")
+    return MemoryCache(ttl_seconds=ttl_seconds, max_entries=max_entries)
+
+
+_cache: Optional[CaptionCache] = None
+_cache_initialized = False
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[CaptionCache]:
+    """Returns the process-wide cache backend, creating it from the environment on first use."""
+    global _cache, _cache_initialized
+    if not _cache_initialized:
+        with _cache_lock:
+            if not _cache_initialized:
+                _cache = create_cache_from_env()
+                _cache_initialized = True
+    return _cache
+
+
+def set_cache(cache: Optional[CaptionCache]) -> None:
+    """Overrides the process-wide cache backend (None disables caching)."""
+    global _cache, _cache_initialized
+    with _cache_lock:
+        _cache = cache
+        _cache_initialized = True
+
+
+def cache_get(key: str) -> Optional[Dict[str, Any]]:
+    """Looks up `key` in the configured cache. Backend failures are logged and treated as a miss."""
+    cache = get_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f"Caption cache lookup failed for key {key}: {e}")
+        return None
+
+
+def cache_set(key: str, value: Dict[str, Any], ttl_seconds: Optional[float] = None) -> None:
+    """
+    Stores `value` under `key` in the configured cache, stamped with the current time as 'fetched_at'.
+    Storing an existing entry again marks it as freshly revalidated. Backend failures are logged and ignored.
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    try:
+        cache.set(key, {**value, "fetched_at": time.time()}, ttl_seconds=ttl_seconds)
+    except Exception as e:
+        logger.warning(f"Caption cache store failed for key {key}: {e}")
+
+
+def restamp_if_unchanged(key: str, entry: Dict[str, Any]) -> None:
+    """
+    Marks the cached entry under `key` as freshly revalidated, unless another worker has stored a
+    different version in the meantime. `entry` is the copy the revalidation started from.
+    """
+    current = cache_get(key)
+    if current is not None and current.get("version") != entry.get("version"):
+        logger.info(f"Cache entry {key} changed during revalidation. Keeping the newer entry.")
+        return
+    cache_set(key, current if current is not None else entry)
+
+
+def is_stale(entry: Dict[str, Any]) -> bool:
+    """Returns True if a cached entry is older than CACHE_FRESH_SECONDS and should be revalidated."""
+    fresh_seconds = float(os.environ.get("CACHE_FRESH_SECONDS", DEFAULT_CACHE_FRESH_SECONDS))
+    return time.time() - entry.get("fetched_at", 0) > fresh_seconds
+
+
+def is_body_expired(entry: Dict[str, Any]) -> bool:
+    """
+    Returns True if the entry's body was downloaded more than the cache TTL ago. Metadata-only
+    revalidation stores the entry again, which keeps it alive past its TTL, so such entries
+    must have their body refetched rather than just revalidated.
+    """
+    cache = get_cache()
+    ttl_seconds = cache.ttl_seconds if cache is not None else DEFAULT_CACHE_TTL_SECONDS
+    return time.time() - entry.get("body_fetched_at", entry.get("fetched_at", 0)) > ttl_seconds
+
+
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+
+def _refresh_backoff_key(key: str) -> str:
+    return f"{key}:refresh-backoff"
+
+
+def begin_refresh(key: str) -> bool:
+    """
+    Claims the background refresh of `key` for this process.
+    Returns False if a refresh of the same key is already running, so concurrent stale hits trigger only one,
+    or if a refresh of the key failed within the last REFRESH_RETRY_SECONDS, so a failing upstream isn't hammered.
+    """
+    if cache_get(_refresh_backoff_key(key)) is not None:
+        return False
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+        return True
+
+
+def end_refresh(key: str, failed: bool = False) -> None:
+    """
+    Releases the refresh claim on `key`. A failed refresh is recorded in the cache, so every worker
+    sharing it backs off before refreshing the key again.
+    """
+    if failed:
+        cache_set(_refresh_backoff_key(key), {}, ttl_seconds=REFRESH_RETRY_SECONDS)
+    with _refreshing_lock:
+        _refreshing.discard(key)
+
+
+def content_version(value: Any) -> str:
+    """Returns a short fingerprint of a JSON-serializable value, used to tie derived cache entries to their source."""
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()[:16]
@@ -0,0 +1,205 @@
+import re
+import math
+import logging
+from typing import List, Dict, Any, Optional, Tuple, Literal
+
+from .caption_compactor import compact_segments
+from .caption_cache import cache_get, cache_set
+
+# Get module-level logger
+logger = logging.getLogger(__name__)
+
+# Constants for chunking
+DEFAULT_CHUNK_BUDGET = 2000
+CHARS_PER_TOKEN = 4  # Rough average for Latin-script text; CJK characters are counted as one token each
+CHUNK_MEMO_TTL_SECONDS = 3600  # Budgets are caller-chosen, so memoized chunks expire long before transcripts
+
+# Latin sentence punctuation only ends a sentence before whitespace ("3.14", "example.com"); CJK text has no spaces
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+|(?<=[。！？])\s*")
+_WORD_RE = re.compile(r"\S+")
+
+BudgetUnit = Literal["chars", "tokens"]
+Span = Tuple[int, int]
+
+
+def _char_cost(char: str, unit: BudgetUnit) -> float:
+    if unit == "chars":
+        return 1
+    # CJK ideographs, kana and hangul mostly map to one token each
+    return 1 if ord(char) >= 0x2E80 else 1 / CHARS_PER_TOKEN
+
+
+def _text_cost(text: str, unit: BudgetUnit) -> float:
+    if unit == "chars":
+        return len(text)
+    return sum(_char_cost(char, unit) for char in text)
+
+
+def estimate_size(text: str, unit: BudgetUnit = "tokens") -> int:
+    """Returns the size of `text` in characters, or an estimate of its token count."""
+    return math.ceil(_text_cost(text, unit))
+
+
+def _cut_to_budget(text: str, start: int, end: int, budget: int, unit: BudgetUnit) -> List[Span]:
+    # Last resort for a single word longer than the budget: cut between characters
+    spans = []
+    cost = 0.0
+    for i in range(start, end):
+        char_cost = _char_cost(text[i], unit)
+        if cost + char_cost > budget and i > start:
+            spans.append((start, i))
+            start, cost = i, 0.0
+        cost += char_cost
+    spans.append((start, end))
+    return spans
+
+
+def _split_sentence(text: str, start: int, end: int, budget: int, unit: BudgetUnit) -> List[Span]:
+    """Splits one sentence of `text` into spans within the budget on word, then character boundaries."""
+    spans: List[Span] = []
+    words = list(_WORD_RE.finditer(text, start, end))
+    if not words:
+        return spans
+    if _text_cost(text[words[0].start():words[-1].end()], unit) <= budget:
+        return [(words[0].start(), words[-1].end())]
+
+    piece: Optional[Span] = None
+    piece_cost = 0.0
+    for word in words:
+        if piece is not None:
+            extra_cost = _text_cost(text[piece[1]:word.end()], unit)
+            if piece_cost + extra_cost <= budget:
+                piece = (piece[0], word.end())
+                piece_cost += extra_cost
+                continue
+            spans.append(piece)
+        word_cost = _text_cost(word.group(), unit)
+        if word_cost > budget:
+            *head, piece = _cut_to_budget(text, word.start(), word.end(), budget, unit)
+            spans.extend(head)
+            piece_cost = _text_cost(text[piece[0]:piece[1]], unit)
+        else:
+            piece, piece_cost = (word.start(), word.end()), word_cost
+    spans.append(piece)
+    return spans
+
+
+def _split_oversized(text: str, budget: int, unit: BudgetUnit) -> List[Span]:
+    """
+    Splits text that doesn't fit the budget on sentence boundaries, falling back to word
+    and then character boundaries for sentences that are still too long.
+
+    :return: The (start, end) offsets of the pieces in `text`, so the original separators can be kept.
+    """
+    spans: List[Span] = []
+    sentence_start = 0
+    for separator in _SENTENCE_SPLIT_RE.finditer(text):
+        spans.extend(_split_sentence(text, sentence_start, separator.start(), budget, unit))
+        sentence_start = separator.end()
+    spans.extend(_split_sentence(text, sentence_start, len(text), budget, unit))
+    return spans
+
+
+def chunk_segments(
+    segments: List[Dict[str, Any]],
+    budget: int = DEFAULT_CHUNK_BUDGET,
+    unit: BudgetUnit = "tokens",
+) -> List[Dict[str, Any]]:
+    """
+    Packs caption segments into chunks whose text fits within `budget`. Chunks break between
+    segments; a segment that alone exceeds the budget is split on sentence edges (then words),
+    with timestamps interpolated across the segment. Segments are joined with newlines, while
+    pieces of the same segment keep their original separator.
+
+    :param segments: A list of dictionaries with 'start' and 'end' (seconds) and 'text' keys.
+    :param budget: The maximum size of a chunk, in `unit`s.
+    :param unit: 'chars' for characters, or 'tokens' for an estimated token count.
+    :return: A list of chunks with 'index', 'start', 'end', 'text' and 'size' keys.
+    """
+    if budget < 1:
+        raise ValueError("Chunk budget must be at least 1.")
+
+    chunks: List[Dict[str, Any]] = []
+    chunk_text = ""
+    chunk_start = chunk_end = 0.0
+    chunk_cost = 0.0
+
+    def flush():
+        chunks.append({
+            "index": len(chunks),
+            "start": chunk_start,
+            "end": chunk_end,
+            "text": chunk_text,
+            "size": estimate_size(chunk_text, unit),
+        })
+
+    for segment in segments:
+        text = segment.get("text", "").strip()
+        if not text:
+            continue
+        start = segment.get("start", 0.0)
+        end = max(segment.get("end", start), start)
+
+        if _text_cost(text, unit) <= budget:
+            pieces = [(start, end, text, "\n")]
+        else:
+            # Interpolate timestamps by the position of each piece within the segment
+            pieces = []
+            previous_end = None
+            for piece_offset, piece_end_offset in _split_oversized(text, budget, unit):
+                separator = "\n" if previous_end is None else text[previous_end:piece_offset]
+                pieces.append((
+                    start + (end - start) * piece_offset / len(text),
+                    start + (end - start) * piece_end_offset / len(text),
+                    text[piece_offset:piece_end_offset],
+                    separator,
+                ))
+                previous_end = piece_end_offset
+
+        for piece_start, piece_end, piece, separator in pieces:
+            piece_cost = _text_cost(piece, unit)
+            if chunk_text and chunk_cost + _text_cost(separator, unit) + piece_cost > budget:
+                flush()
+                chunk_text = ""
+            if chunk_text:
+                chunk_text += separator + piece
+                chunk_cost += _text_cost(separator, unit) + piece_cost
+            else:
+                chunk_text, chunk_start, chunk_cost = piece, piece_start, piece_cost
+            chunk_end = piece_end
+
+    if chunk_text:
+        flush()
+    return chunks
+
+
+def get_or_build_chunks(
+    transcript_key: str,
+    version: Optional[str],
+    segments: List[Dict[str, Any]],
+    budget: int,
+    unit: BudgetUnit,
+    compact: bool,
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Returns the chunks of a cached transcript, computing them only once per transcript version,
+    budget and compaction setting. The result is memoized in the caption cache next to the transcript,
+    with a short TTL since every distinct budget gets its own entry.
+
+    :param transcript_key: The cache key of the transcript the segments came from.
+    :param version: The content version of the cached transcript; memoized chunks of other versions are ignored.
+    :return: A tuple of the chunks and the compaction statistics (None unless `compact`).
+    """
+    memo_key = f"{transcript_key}:chunks:{unit}:{budget}:{'compact' if compact else 'raw'}"
+    memo = cache_get(memo_key)
+    if memo is not None and memo.get("version") == version:
+        logger.info(f"Serving memoized chunks: {memo_key}")
+        return memo["chunks"], memo.get("compaction")
+
+    compaction_stats = None
+    if compact:
+        segments, compaction_stats = compact_segments(segments)
+    chunks = chunk_segments(segments, budget, unit)
+    logger.info(f"Split transcript into {len(chunks)} chunks of at most {budget} {unit}.")
+    cache_set(memo_key, {"version": version, "chunks": chunks, "compaction": compaction_stats}, ttl_seconds=CHUNK_MEMO_TTL_SECONDS)
+    return chunks, compaction_stats
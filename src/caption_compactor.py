@@ -0,0 +1,162 @@
+import re
+import html
+import logging
+from typing import List, Dict, Any, Tuple
+
+# Get module-level logger
+logger = logging.getLogger(__name__)
+
+# Constants for compaction
+MAX_BLOCK_SECONDS = 30.0  # Target upper bound for the duration of a merged block
+MIN_OVERLAP_CHARS = 4  # Shorter prefix/suffix overlaps are treated as coincidence, not rolling repeats
+MIN_FULL_REPEAT_CHARS = 8  # Shorter segments that fully repeat the previous one are likely spoken again ("no, no")
+SENTENCE_ENDINGS = (".", "!", "?", "。", "！", "？", "…")
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_caption_text(text: str) -> str:
+    """
+    Normalizes a single caption fragment: strips inline markup such as <font> or <i> tags,
+    decodes HTML entities and collapses all runs of whitespace into single spaces.
+    """
+    text = _TAG_RE.sub("", text)
+    text = html.unescape(text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def _is_word_char(char: str) -> bool:
+    # Only ASCII letters/digits are space-delimited words; CJK characters can be split anywhere
+    return char.isascii() and char.isalnum()
+
+
+def _overlap_length(previous: str, current: str) -> int:
+    """
+    Returns the length of the longest prefix of `current` that is also a suffix of `previous`.
+    Uses the KMP prefix function, so the cost is linear in the length of the two fragments.
+    """
+    if not previous or not current:
+        return 0
+    tail = previous[-len(current):]
+    combined = current + "\x00" + tail
+    prefix = [0] * len(combined)
+    for i in range(1, len(combined)):
+        k = prefix[i - 1]
+        while k and combined[i] != combined[k]:
+            k = prefix[k - 1]
+        if combined[i] == combined[k]:
+            k += 1
+        prefix[i] = k
+    return prefix[-1]
+
+
+def _strip_repeated_prefix(previous: str, current: str) -> str:
+    """
+    Removes the part of `current` that merely repeats the end of `previous`, as produced by
+    rolling auto-generated captions. Returns an empty string if `current` is a full repeat.
+    """
+    overlap = _overlap_length(previous, current)
+    full_repeat = overlap == len(current)
+    if overlap < (MIN_FULL_REPEAT_CHARS if full_repeat else MIN_OVERLAP_CHARS):
+        return current
+    # Don't match the tail of a word in `previous` ("the kitten" / "ten")
+    if overlap < len(previous) and _is_word_char(previous[-overlap - 1]) and _is_word_char(current[0]):
+        return current
+    if full_repeat:
+        return ""
+    # Don't cut through the middle of a word ("the" / "there")
+    if _is_word_char(current[overlap - 1]) and _is_word_char(current[overlap]):
+        return current
+    return current[overlap:].strip()
+
+
+def _join_fragments(left: str, right: str) -> str:
+    if not left:
+        return right
+    if not right:
+        return left
+    # CJK text is not space-delimited, so only insert a space when either side is ASCII
+    if left[-1].isascii() or right[0].isascii():
+        return f"{left} {right}"
+    return left + right
+
+
+def _joined_size(segments: List[Dict[str, Any]]) -> int:
+    # Size of the "\n".join output the fetchers produce for plain text
+    if not segments:
+        return 0
+    return sum(len(segment["text"]) for segment in segments) + len(segments) - 1
+
+
+def compact_segments(
+    segments: List[Dict[str, Any]],
+    max_block_seconds: float = MAX_BLOCK_SECONDS,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Compacts a list of caption segments in a single linear pass: normalizes whitespace and markup,
+    drops fragments that repeat the previous segment, and merges adjacent short segments into
+    sentence-level blocks no longer than `max_block_seconds`.
+
+    :param segments: A list of dictionaries with 'start' and 'end' (seconds) and 'text' keys.
+    :param max_block_seconds: The target upper bound for the duration of a merged block.
+    :return: A tuple of the compacted segments (same shape as the input) and a statistics dictionary
+             describing the size reduction.
+    """
+    compacted: List[Dict[str, Any]] = []
+    block: Dict[str, Any] = {}
+    previous_text = ""
+    duplicates_removed = 0
+
+    for segment in segments:
+        normalized = normalize_caption_text(segment.get("text", ""))
+        if not normalized:
+            # Markup-only or blank segments carry no text and aren't repeats of anything
+            continue
+        text = _strip_repeated_prefix(previous_text, normalized)
+        previous_text = normalized
+
+        start = segment.get("start", 0.0)
+        end = max(segment.get("end", start), start)
+
+        if not text:
+            duplicates_removed += 1
+            # The repeated words are still on screen, so the block showing them lasts until the repeat ends
+            last_block = block or (compacted[-1] if compacted else None)
+            if last_block is not None:
+                last_block["end"] = max(last_block["end"], end)
+            continue
+
+        if block and end - block["start"] > max_block_seconds:
+            compacted.append(block)
+            block = {}
+
+        if block:
+            block["text"] = _join_fragments(block["text"], text)
+            block["end"] = max(block["end"], end)
+        else:
+            block = {"start": start, "end": end, "text": text}
+
+        # Close the block on a sentence boundary once it covers at least half of the target duration
+        if block["text"].endswith(SENTENCE_ENDINGS) and block["end"] - block["start"] >= max_block_seconds / 2:
+            compacted.append(block)
+            block = {}
+
+    if block:
+        compacted.append(block)
+
+    original_chars = _joined_size(segments)
+    compacted_chars = _joined_size(compacted)
+    stats = {
+        "original_segments": len(segments),
+        "compacted_segments": len(compacted),
+        "duplicates_removed": duplicates_removed,
+        "original_chars": original_chars,
+        "compacted_chars": compacted_chars,
+        "reduction_ratio": round(1 - compacted_chars / original_chars, 4) if original_chars else 0.0,
+    }
+    logger.info(
+        f"Compacted {stats['original_segments']} segments into {stats['compacted_segments']} blocks, "
+        f"{original_chars} -> {compacted_chars} chars ({stats['reduction_ratio']:.1%} reduction)"
+    )
+    return compacted, stats
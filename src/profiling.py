@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Get module-level logger
+logger = logging.getLogger(__name__)
+
+# Constants for the sampling profiler (overridable via environment variables)
+DEFAULT_PROFILE_INTERVAL_MS = 5
+DEFAULT_PROFILE_DIR = "profiles"
+
+
+class SamplingProfiler:
+    """
+    Samples the call stack of one thread at a fixed interval from a background thread
+    and aggregates the samples in the folded format used by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id: int, interval_seconds: float):
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
+
+
+def _profile_threshold_ms() -> Optional[float]:
+    threshold = os.environ.get("PROFILE_THRESHOLD_MS")
+    return float(threshold) if threshold else None
+
+
+@contextmanager
+def profile_request(name: str) -> Iterator[None]:
+    """
+    Profiles the enclosed request if PROFILE_THRESHOLD_MS is set. Requests slower than the threshold
+    have their sampled stacks written to PROFILE_DIR as a '.folded' file; faster ones are discarded.
+
+    The calling thread is sampled, so for async handlers the stacks also include any other
+    coroutines the event loop ran concurrently.
+    """
+    threshold_ms = _profile_threshold_ms()
+    if threshold_ms is None:
+        yield
+        return
+
+    interval_ms = float(os.environ.get("PROFILE_INTERVAL_MS", DEFAULT_PROFILE_INTERVAL_MS))
+    profiler = SamplingProfiler(threading.get_ident(), interval_ms / 1000)
+    profiler.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        profiler.stop()
+        if elapsed_ms >= threshold_ms:
+            _write_profile(name, elapsed_ms, profiler)
+
+
+def _write_profile(name: str, elapsed_ms: float, profiler: SamplingProfiler) -> None:
+    profile_dir = os.environ.get("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{name}-{int(time.time() * 1000)}-{os.getpid()}-{int(elapsed_ms)}ms.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(profiler.folded())
+        logger.warning(f"Slow request {name} took {elapsed_ms:.0f} ms; profile written to {path}")
+    except OSError as e:
+        logger.error(f"Failed to write profile for slow request {name}: {e}")
@@ -0,0 +1,248 @@
+import os
+import re
+import time
+import logging
+import threading
+import itertools
+from typing import Optional, List, Dict, Any, Callable
+from urllib.parse import urlparse
+
+from requests import Session, HTTPError
+from requests.exceptions import ProxyError
+from youtube_transcript_api import YouTubeTranscriptApi, RequestBlocked, YouTubeRequestFailed
+from youtube_transcript_api.proxies import GenericProxyConfig
+
+from .caption_cache import cache_get, cache_set
+
+# Get module-level logger
+logger = logging.getLogger(__name__)
+
+# Constants for proxy health tracking
+QUARANTINE_SECONDS = 300  # Base quarantine after a block; doubles on consecutive blocks
+MAX_QUARANTINE_SECONDS = 3600
+MAX_CONSECUTIVE_FAILURES = 3  # Non-block failures (e.g. dead proxy) tolerated before quarantine
+SCORE_DECAY = 0.8  # Weight of the previous health score in the moving average
+HTTP_TOO_MANY_REQUESTS = 429
+QUARANTINE_SYNC_SECONDS = 5  # How often quarantines recorded by other workers are read from the shared cache
+
+# urllib3 only reports the status of a rejected CONNECT tunnel in the error message
+_TUNNEL_STATUS_RE = re.compile(r"Tunnel connection failed: (\d{3})")
+
+
+def _proxy_status_code(error: ProxyError) -> Optional[int]:
+    """Returns the HTTP status the proxy answered with, if it rejected the request or tunnel."""
+    if error.response is not None:
+        return error.response.status_code
+    match = _TUNNEL_STATUS_RE.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_block_error(error: Exception) -> bool:
+    """Returns True if the error means YouTube (or the proxy) is refusing or rate limiting our requests."""
+    if isinstance(error, RequestBlocked):  # Includes IpBlocked
+        return True
+    if isinstance(error, YouTubeRequestFailed):
+        # The library raises it while handling the HTTPError, which keeps the response as the context
+        http_error = error.__cause__ or error.__context__
+        return (
+            isinstance(http_error, HTTPError)
+            and http_error.response is not None
+            and http_error.response.status_code == HTTP_TOO_MANY_REQUESTS
+        )
+    if isinstance(error, ProxyError):
+        return _proxy_status_code(error) == HTTP_TOO_MANY_REQUESTS
+    return False
+
+
+def _quarantine_key(endpoint: "ProxyEndpoint") -> str:
+    # Keyed by the redacted URL so credentials never end up in the shared cache
+    return f"proxy-quarantine:{endpoint.name}"
+
+
+def _redact_proxy_url(url: Optional[str]) -> str:
+    # Never expose proxy credentials in logs or metrics
+    if url is None:
+        return "direct"
+    parsed = urlparse(url)
+    netloc = parsed.hostname or ""
+    if parsed.port:
+        netloc += f":{parsed.port}"
+    return f"{parsed.scheme}://{netloc}"
+
+
+def _create_api(proxy_url: Optional[str]) -> YouTubeTranscriptApi:
+    # One requests.Session per egress so connections (and cookies) are reused per proxy
+    proxy_config = GenericProxyConfig(http_url=proxy_url, https_url=proxy_url) if proxy_url else None
+    return YouTubeTranscriptApi(proxy_config=proxy_config, http_client=Session())
+
+
+class ProxyEndpoint:
+    """A single egress (a proxy, or the direct connection) with its own session and health statistics."""
+
+    def __init__(self, proxy_url: Optional[str], api: YouTubeTranscriptApi):
+        self.proxy_url = proxy_url
+        self.name = _redact_proxy_url(proxy_url)
+        self.api = api
+        self.in_flight = 0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.blocks = 0
+        self.consecutive_failures = 0
+        self.consecutive_blocks = 0
+        self.score = 1.0
+        self.quarantined_until = 0.0
+
+    def is_quarantined(self, now: float) -> bool:
+        return self.quarantined_until > now
+
+    def metrics(self, now: float) -> Dict[str, Any]:
+        return {
+            "proxy": self.name,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "blocks": self.blocks,
+            "score": round(self.score, 3),
+            "quarantined_for_seconds": max(0, round(self.quarantined_until - now)),
+        }
+
+
+class ProxyPool:
+    """
+    Pool of egress endpoints for YouTube requests. Endpoints are picked round-robin or by least
+    in-flight requests (ties broken by health score), and endpoints that get blocked or keep
+    failing are quarantined with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        proxy_urls: Optional[List[str]] = None,
+        strategy: str = "least_loaded",
+        quarantine_seconds: float = QUARANTINE_SECONDS,
+        api_factory: Callable[[Optional[str]], YouTubeTranscriptApi] = _create_api,
+    ):
+        if strategy not in ("least_loaded", "round_robin"):
+            raise ValueError(f"Unknown proxy selection strategy: {strategy}")
+        self.strategy = strategy
+        self.quarantine_seconds = quarantine_seconds
+        # Without proxies the pool holds a single direct endpoint, so callers don't need a separate code path
+        urls: List[Optional[str]] = list(proxy_urls) if proxy_urls else [None]
+        self.endpoints = [ProxyEndpoint(url, api_factory(url)) for url in urls]
+        self._round_robin = itertools.cycle(range(len(self.endpoints)))
+        self._lock = threading.Lock()
+        self._last_quarantine_sync = 0.0
+
+    def _sync_quarantines(self, now: float) -> None:
+        """
+        Adopts quarantines that other worker processes stored in the shared caption cache, so a blocked
+        proxy is skipped by every worker instead of being rediscovered by each one.
+        """
+        if now - self._last_quarantine_sync < QUARANTINE_SYNC_SECONDS:
+            return
+        self._last_quarantine_sync = now
+        for endpoint in self.endpoints:
+            shared = cache_get(_quarantine_key(endpoint))
+            if shared is not None:
+                with self._lock:
+                    endpoint.quarantined_until = max(endpoint.quarantined_until, shared["until"])
+
+    def acquire(self) -> ProxyEndpoint:
+        """
+        Picks an endpoint for a request and marks it in flight. If every endpoint is quarantined,
+        the one whose quarantine ends first is used rather than failing outright.
+        """
+        now = time.time()
+        self._sync_quarantines(now)
+        with self._lock:
+            healthy = [e for e in self.endpoints if not e.is_quarantined(now)]
+            if not healthy:
+                endpoint = min(self.endpoints, key=lambda e: e.quarantined_until)
+                logger.warning(f"All proxies are quarantined. Using {endpoint.name}, which recovers first.")
+            elif self.strategy == "round_robin":
+                endpoint = next(self.endpoints[i] for i in self._round_robin if self.endpoints[i] in healthy)
+            else:
+                endpoint = min(healthy, key=lambda e: (e.in_flight, -e.score))
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+        logger.debug(f"Acquired egress {endpoint.name} (in flight: {endpoint.in_flight})")
+        return endpoint
+
+    def release(self, endpoint: ProxyEndpoint) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def record_success(self, endpoint: ProxyEndpoint) -> None:
+        with self._lock:
+            endpoint.successes += 1
+            endpoint.consecutive_failures = 0
+            endpoint.consecutive_blocks = 0
+            endpoint.score = SCORE_DECAY * endpoint.score + (1 - SCORE_DECAY)
+
+    def record_failure(self, endpoint: ProxyEndpoint, error: Exception) -> None:
+        """Updates the endpoint's health after a failed request and quarantines it if needed."""
+        blocked = is_block_error(error)
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            endpoint.score = SCORE_DECAY * endpoint.score
+            if blocked:
+                endpoint.blocks += 1
+                endpoint.consecutive_blocks += 1
+                quarantine = min(
+                    self.quarantine_seconds * 2 ** (endpoint.consecutive_blocks - 1), MAX_QUARANTINE_SECONDS
+                )
+            elif endpoint.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                quarantine = self.quarantine_seconds
+            else:
+                return
+            endpoint.quarantined_until = time.time() + quarantine
+        # Share the quarantine with the other workers through the caption cache backend
+        cache_set(_quarantine_key(endpoint), {"until": endpoint.quarantined_until}, ttl_seconds=quarantine)
+        reason = "blocked" if blocked else f"failed {endpoint.consecutive_failures} times in a row"
+        logger.warning(f"Egress {endpoint.name} {reason}; quarantined for {quarantine:.0f} seconds.")
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """
+        Returns per-endpoint statistics. Counters are those of this worker process; quarantines
+        include those recorded by other workers sharing the cache backend.
+        """
+        now = time.time()
+        self._sync_quarantines(now)
+        with self._lock:
+            return [endpoint.metrics(now) for endpoint in self.endpoints]
+
+
+def create_proxy_pool_from_env() -> ProxyPool:
+    """
+    Creates the proxy pool from YOUTUBE_PROXIES, a comma-separated list of proxy URLs
+    (http://, https://, socks5:// - SOCKS requires `pip install requests[socks]`).
+    """
+    proxy_urls = [url.strip() for url in os.environ.get("YOUTUBE_PROXIES", "").split(",") if url.strip()]
+    strategy = os.environ.get("YOUTUBE_PROXY_STRATEGY", "least_loaded")
+    quarantine_seconds = float(os.environ.get("YOUTUBE_PROXY_QUARANTINE_SECONDS", QUARANTINE_SECONDS))
+    if proxy_urls:
+        logger.info(f"Using {len(proxy_urls)} YouTube egress proxies with {strategy} selection.")
+    return ProxyPool(proxy_urls, strategy=strategy, quarantine_seconds=quarantine_seconds)
+
+
+_proxy_pool: Optional[ProxyPool] = None
+_proxy_pool_lock = threading.Lock()
+
+
+def get_proxy_pool() -> ProxyPool:
+    """Returns the process-wide proxy pool, creating it from the environment on first use."""
+    global _proxy_pool
+    if _proxy_pool is None:
+        with _proxy_pool_lock:
+            if _proxy_pool is None:
+                _proxy_pool = create_proxy_pool_from_env()
+    return _proxy_pool
+
+
+def set_proxy_pool(pool: Optional[ProxyPool]) -> None:
+    """Overrides the process-wide proxy pool (None recreates it from the environment on next use)."""
+    global _proxy_pool
+    with _proxy_pool_lock:
+        _proxy_pool = pool
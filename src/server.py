@@ -1,6 +1,9 @@
 # MCP Server for YouTube Captions
 
+import json
 import logging # Import logging module
+import os
+import time
 import threading
 
 from mcp.server.fastmcp import FastMCP
@@ -8,6 +11,9 @@ from typing import Literal, Optional # Import Literal and Optional
 
 from .youtube_fetcher import fetch_youtube_captions # Import YouTube fetcher function
 from .bilibili_fetcher import fetch_bilibili_subtitle # Import Bilibili fetcher function
+from .proxy_pool import get_proxy_pool
+from .profiling import profile_request
+from .caption_chunker import DEFAULT_CHUNK_BUDGET
 
 _thread_local = threading.local()
 
@@ -30,6 +36,20 @@ root_logger.addFilter(test_method_filter)
 mcp = FastMCP(server_name="caption_fetcher_mcp", port=3521, host="0.0.0.0")
 logging.info("MCP Server instance created.")
 
+def _add_serialization_timing(result):
+    """
+    Adds the cost of serializing the response to a debug timing breakdown, and to its total. The
+    response is serialized once here to measure it, which the framework then repeats when replying.
+    """
+    if isinstance(result, dict) and "timings" in result:
+        start = time.perf_counter()
+        json.dumps(result)
+        serialization_ms = (time.perf_counter() - start) * 1000
+        timings = result["timings"]
+        timings["stages_ms"]["serialization"] = round(serialization_ms, 3)
+        timings["total_ms"] = round(timings["total_ms"] + serialization_ms, 3)
+    return result
+
 # MCP Server class using FastMCP
 # Your Bilibili Credentials
 # Get credentials from environment variables
@@ -37,12 +57,29 @@ logging.info("MCP Server instance created.")
     name="get_youtube_captions",
     description="Fetches captions for a given YouTube video URL.",
 )
-def handle_get_youtube_captions_tool(youtube_url: str, preferred_lang: Optional[str] = None):
+def handle_get_youtube_captions_tool(
+    youtube_url: str,
+    preferred_lang: Optional[str] = None,
+    compact: bool = False,
+    debug_timings: bool = False,
+    output_mode: Literal["full", "chunks"] = "full",
+    chunk_budget: int = DEFAULT_CHUNK_BUDGET,
+    budget_unit: Literal["chars", "tokens"] = "tokens",
+):
     """
     Handles the request to get YouTube captions by calling the youtube_fetcher module.
     """
-    # Pass the logger instance to the fetcher function
-    return fetch_youtube_captions(youtube_url, preferred_lang=preferred_lang)
+    with profile_request("get_youtube_captions"):
+        result = fetch_youtube_captions(
+            youtube_url,
+            preferred_lang=preferred_lang,
+            compact=compact,
+            debug_timings=debug_timings,
+            output_mode=output_mode,
+            chunk_budget=chunk_budget,
+            budget_unit=budget_unit,
+        )
+    return _add_serialization_timing(result)
 
 
 @mcp.tool(
@@ -53,21 +90,87 @@ async def handle_get_bilibili_captions_tool(
     url: str,
     preferred_lang: str = "zh-CN",
     output_format: Literal["text", "timestamped"] = "text",
+    compact: bool = False,
+    debug_timings: bool = False,
+    output_mode: Literal["full", "chunks"] = "full",
+    chunk_budget: int = DEFAULT_CHUNK_BUDGET,
+    budget_unit: Literal["chars", "tokens"] = "tokens",
 ):
     """
     Fetches subtitles for a given Bilibili video URL by calling the bilibili_fetcher module.
     """
     # Pass credentials and logger to the fetcher function
-    return await fetch_bilibili_subtitle(
-        url,
-        preferred_lang=preferred_lang,
-        output_format=output_format,
+    with profile_request("get_bilibili_captions"):
+        result = await fetch_bilibili_subtitle(
+            url,
+            preferred_lang=preferred_lang,
+            output_format=output_format,
+            compact=compact,
+            debug_timings=debug_timings,
+            output_mode=output_mode,
+            chunk_budget=chunk_budget,
+            budget_unit=budget_unit,
+        )
+    return _add_serialization_timing(result)
+
+
+@mcp.resource(
+    "metrics://youtube-proxies",
+    name="youtube_proxy_metrics",
+    description="Per-egress request, failure, block and quarantine statistics for YouTube fetching. Counters are per worker process; quarantines are shared through the cache backend.",
+    mime_type="application/json",
+)
+def handle_youtube_proxy_metrics_resource() -> str:
+    """
+    Returns the YouTube proxy pool metrics of this worker process. With WORKERS > 1, each read is
+    answered by one worker, so the counters only cover the requests that worker handled.
+    """
+    return json.dumps(get_proxy_pool().metrics())
+
+
+def create_app():
+    """
+    Builds the ASGI app for production mode. Each worker process calls this factory.
+    Stateless streamable HTTP means no session lives in a worker, so any worker
+    (or replica behind a load balancer) can serve any request.
+    """
+    mcp.settings.stateless_http = True
+    mcp.settings.json_response = True
+    return mcp.streamable_http_app()
+
+
+def run_workers(workers: int):
+    """
+    Runs the server in production mode: `workers` uvicorn processes under uvicorn's
+    supervisor (which restarts crashed workers), sharing the caption cache through
+    the disk or Redis backend. On SIGTERM/SIGINT each worker stops accepting new
+    connections and drains in-flight requests for up to GRACEFUL_SHUTDOWN_SECONDS.
+    """
+    import uvicorn
+
+    # An in-memory cache isn't shared between processes, so default to the on-host disk store
+    if os.environ.get("CACHE_BACKEND", "memory").lower() == "memory":
+        logging.info("Multiple workers requested; using the disk caption cache so workers share entries.")
+        os.environ["CACHE_BACKEND"] = "disk"
+
+    uvicorn.run(
+        "src.server:create_app",
+        factory=True,
+        host=mcp.settings.host,
+        port=mcp.settings.port,
+        workers=workers,
+        timeout_graceful_shutdown=int(os.environ.get("GRACEFUL_SHUTDOWN_SECONDS", "30")),
+        log_level=mcp.settings.log_level.lower(),
     )
 
 
 # To run as an MCP server, uncomment and execute the module-level mcp instance:
 if __name__ == "__main__":
-    # The FastMCP instance is already created at the module level.
-    # Just call its run method, specifying the transport.
-    # mcp.run(transport="streamable-http")
-    mcp.run(transport="streamable-http")
\ No newline at end of file
+    workers = int(os.environ.get("WORKERS", "1"))
+    if workers > 1:
+        run_workers(workers)
+    else:
+        # The FastMCP instance is already created at the module level.
+        # Just call its run method, specifying the transport.
+        # mcp.run(transport="streamable-http")
+        mcp.run(transport="streamable-http")
@@ -0,0 +1,31 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator
+
+
+class RequestTimings:
+    """
+    Collects a per-stage wall-clock breakdown of a single caption request.
+    Stages that run more than once (e.g. download retries) accumulate.
+    """
+
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total_ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "stages_ms": {name: round(seconds * 1000, 3) for name, seconds in self._stages.items()},
+        }
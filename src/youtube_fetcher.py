@@ -1,10 +1,17 @@
 import re
 import re
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Literal
 import time # Import time for retry delay
+import threading
 
-from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
+from youtube_transcript_api import TranscriptsDisabled, NoTranscriptFound
+
+from .caption_compactor import compact_segments
+from .caption_cache import cache_get, cache_set, restamp_if_unchanged, is_stale, is_body_expired, begin_refresh, end_refresh, content_version
+from .proxy_pool import get_proxy_pool, is_block_error, ProxyPool, ProxyEndpoint
+from .timings import RequestTimings
+from .caption_chunker import get_or_build_chunks, DEFAULT_CHUNK_BUDGET, BudgetUnit
 
 # Get module-level logger
 logger = logging.getLogger(__name__)
@@ -35,102 +42,290 @@ def extract_youtube_video_id(youtube_url: str) -> Optional[str]:
     logger.warning(f"Could not extract video ID from URL: {youtube_url}")
     return None
 
+def _build_caption_response(entry: Dict[str, Any], cache_key: str, video_id: str, output_options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Builds the caption response from a cached transcript entry: the joined captions, or token-budgeted
+    chunks in 'chunks' output mode, optionally compacting the segments first.
+    """
+    segments = entry["segments"]
+    languages_used = entry["language_codes_used"]
+    compact = output_options.get("compact", False)
+
+    if output_options.get("output_mode") == "chunks":
+        budget = output_options.get("chunk_budget", DEFAULT_CHUNK_BUDGET)
+        unit = output_options.get("budget_unit", "tokens")
+        chunks, stats = get_or_build_chunks(cache_key, entry.get("version"), segments, budget, unit, compact)
+        response = {"chunks": chunks, "video_id": video_id, "language_codes_used": languages_used}
+        if stats is not None:
+            response["compaction"] = stats
+        return response
+
+    if not compact:
+        captions = "\n".join([segment["text"] for segment in segments])
+        return {"captions": captions, "video_id": video_id, "language_codes_used": languages_used}
+
+    compacted, stats = compact_segments(segments)
+    captions = "\n".join([segment["text"] for segment in compacted])
+    return {"captions": captions, "video_id": video_id, "language_codes_used": languages_used, "compaction": stats}
+
+def _track_signature(transcript_options) -> List[List[Any]]:
+    """
+    Returns a cheap, JSON-serializable summary of the available tracks, used to detect changes on revalidation.
+    """
+    return sorted([t.language_code, t.is_generated] for t in transcript_options)
+
+def _store_transcript(cache_key: str, transcript_list, languages_used: str, transcript_options) -> Dict[str, Any]:
+    """
+    Converts fetched transcript snippets into plain segments and stores them in the caption cache.
+    """
+    segments = [{"start": item.start, "end": item.start + item.duration, "text": item.text} for item in transcript_list]
+    entry = {
+        "segments": segments,
+        "language_codes_used": languages_used,
+        "tracks": _track_signature(transcript_options),
+        "version": content_version(segments),
+        "body_fetched_at": time.time(),
+    }
+    cache_set(cache_key, entry)
+    return entry
+
+def _refresh_transcript(video_id: str, preferred_lang: Optional[str], cache_key: str, cached: Dict[str, Any]) -> None:
+    """
+    Revalidates a stale cache entry in the background. The track listing is compared first;
+    the transcript body is only refetched if the available tracks changed, or if the body is older
+    than the cache TTL (edited CC and regenerated ASR tracks don't change the listing).
+    Failures keep the stale entry in place and back off further refreshes of the key.
+    """
+    logger.info(f"Revalidating stale transcript cache entry: {cache_key}")
+    proxy_pool = get_proxy_pool()
+    succeeded = False
+    try:
+        endpoint = proxy_pool.acquire()
+        try:
+            tracks = _track_signature(endpoint.api.list(video_id))
+            proxy_pool.record_success(endpoint)
+        except Exception as e:
+            proxy_pool.record_failure(endpoint, e)
+            logger.warning(f"Background refresh of {cache_key} failed: {e}")
+            return
+        finally:
+            proxy_pool.release(endpoint)
+
+        if tracks == cached.get("tracks") and not is_body_expired(cached):
+            logger.info(f"Track listing for video ID {video_id} unchanged. Keeping cached transcript.")
+            restamp_if_unchanged(cache_key, cached)
+            succeeded = True
+            return
+        logger.info(f"Track listing for video ID {video_id} changed or cached body expired. Refetching transcript.")
+        result = _fetch_and_cache_transcript(
+            video_id, preferred_lang, cache_key, output_options={}, timings=RequestTimings()
+        )
+        if "error" in result:
+            logger.warning(f"Background refresh of {cache_key} failed: {result['error']['message']}")
+        else:
+            succeeded = True
+    finally:
+        end_refresh(cache_key, failed=not succeeded)
+
 def fetch_youtube_captions(
     youtube_url: str,
     preferred_lang: Optional[str] = None,
+    compact: bool = False,
+    debug_timings: bool = False,
+    output_mode: Literal["full", "chunks"] = "full",
+    chunk_budget: int = DEFAULT_CHUNK_BUDGET,
+    budget_unit: BudgetUnit = "tokens",
 ) -> Dict[str, Any]:
     """
     Fetches captions for a given YouTube video URL.
 
     :param youtube_url: The URL of the YouTube video.
     :param preferred_lang: Optional preferred language code (e.g., 'en').
+    :param compact: If True, deduplicates rolling repeats and merges short segments into sentence-level blocks.
+                    The size reduction is reported under the 'compaction' key.
+    :param debug_timings: If True, a per-stage timing breakdown is added under the 'timings' key.
+    :param output_mode: 'full' returns the joined 'captions' string; 'chunks' returns a 'chunks' list instead,
+                        each chunk fitting `chunk_budget` and carrying its start/end timestamps.
+    :param chunk_budget: The maximum size of a chunk in 'chunks' output mode.
+    :param budget_unit: The unit of `chunk_budget`: 'tokens' (estimated) or 'chars'.
     :return: A dictionary containing captions, video_id, and language_codes_used, or an error dictionary.
     """
+    output_options = {
+        "compact": compact,
+        "output_mode": output_mode,
+        "chunk_budget": chunk_budget,
+        "budget_unit": budget_unit,
+    }
+    timings = RequestTimings()
+    result = _fetch_youtube_captions(youtube_url, preferred_lang, output_options, timings)
+    if debug_timings:
+        result["timings"] = timings.to_dict()
+    return result
+
+def _fetch_youtube_captions(
+    youtube_url: str,
+    preferred_lang: Optional[str],
+    output_options: Dict[str, Any],
+    timings: RequestTimings,
+) -> Dict[str, Any]:
+    """
+    Implements fetch_youtube_captions, recording each stage in `timings`.
+    """
     logger.info(f"Received request for URL: {youtube_url} with preferred language: {preferred_lang}")
 
-    video_id = extract_youtube_video_id(youtube_url)
+    chunk_budget = output_options.get("chunk_budget", DEFAULT_CHUNK_BUDGET)
+    if output_options.get("output_mode") == "chunks" and chunk_budget < 1:
+        error_msg = f"Invalid chunk budget: {chunk_budget}. It must be at least 1."
+        logger.error(error_msg)
+        return {"error": {"message": error_msg, "code": "INVALID_CHUNK_BUDGET"}}
+
+    with timings.stage("url_parse"):
+        video_id = extract_youtube_video_id(youtube_url)
     if not video_id:
         error_msg = "Invalid YouTube URL or could not extract video ID."
         logger.error(f"Failed to extract video ID from URL: {youtube_url}")
         return {"error": {"message": error_msg, "code": "INVALID_URL"}}
 
+    cache_key = f"youtube:{video_id}:{preferred_lang or 'auto'}"
+    with timings.stage("cache_lookup"):
+        cached = cache_get(cache_key)
+    if cached is not None:
+        logger.info(f"Serving cached transcript for video ID: {video_id} (language: {cached['language_codes_used']})")
+        if is_stale(cached) and begin_refresh(cache_key):
+            # Stale-while-revalidate: answer from cache now, revalidate upstream in the background
+            threading.Thread(
+                target=_refresh_transcript, args=(video_id, preferred_lang, cache_key, cached), daemon=True
+            ).start()
+        with timings.stage("formatting"):
+            return _build_caption_response(cached, cache_key, video_id, output_options)
+
+    return _fetch_and_cache_transcript(video_id, preferred_lang, cache_key, output_options, timings)
+
+def _choose_default_transcript(video_id: str, transcript_options):
+    """
+    Picks the transcript to use when no language was requested: a manually created (CC) transcript in the
+    original video language (inferred from ASR), then the ASR transcript, then the general fallback priority.
+    """
+    # Find the original video language from ASR transcripts
+    asr_transcripts = [t for t in transcript_options if t.is_generated]
+    original_video_lang = None
+    if asr_transcripts:
+        original_video_lang = asr_transcripts[0].language_code
+        logger.info(f"Inferred original video language from ASR: {original_video_lang}")
+
+    chosen_transcript = None
+    if original_video_lang:
+        # Prioritize manually created (CC) transcripts in the original video language
+        matching_cc_transcripts = [t for t in transcript_options if not t.is_generated and t.language_code == original_video_lang]
+        if matching_cc_transcripts:
+            chosen_transcript = matching_cc_transcripts[0] # Pick the first matching CC transcript
+            logger.info(f"Selected manually created transcript in original video language: {chosen_transcript.language_code}")
+        else:
+            # If no matching CC transcript, use the ASR transcript in the original video language
+            chosen_transcript = asr_transcripts[0] # This should exist if original_video_lang was determined
+            logger.info(f"No matching CC transcript found. Selected ASR transcript in original video language: {chosen_transcript.language_code}")
+    else:
+        # Fallback if no ASR transcripts are available (cannot determine original language)
+        logger.warning(f"No ASR transcripts found for video ID: {video_id}. Falling back to general priority.")
+        # Fallback logic: Prioritize 'en' CC, then first available CC, then 'en' ASR, then first available ASR
+        cc_transcripts = [t for t in transcript_options if not t.is_generated]
+        asr_transcripts_fallback = [t for t in transcript_options if t.is_generated] # Re-filter ASR for fallback
+
+        en_cc = next((t for t in cc_transcripts if t.language_code == 'en'), None)
+        if en_cc:
+            chosen_transcript = en_cc
+            logger.info(f"Fallback: Selected 'en' manually created transcript.")
+        elif cc_transcripts:
+            chosen_transcript = cc_transcripts[0]
+            logger.info(f"Fallback: Selected first available manually created transcript: {chosen_transcript.language_code}")
+        else:
+            en_asr = next((t for t in asr_transcripts_fallback if t.language_code == 'en'), None)
+            if en_asr:
+                chosen_transcript = en_asr
+                logger.info(f"Fallback: Selected 'en' auto-generated transcript.")
+            elif asr_transcripts_fallback:
+                chosen_transcript = asr_transcripts_fallback[0]
+                logger.info(f"Fallback: Selected first available auto-generated transcript: {chosen_transcript.language_code}")
+    return chosen_transcript
+
+def _switch_endpoint(proxy_pool: ProxyPool, endpoint: ProxyEndpoint, error: Exception, timings: RequestTimings) -> ProxyEndpoint:
+    """
+    Moves a blocked request to another egress: the blocked endpoint is quarantined and released, and a
+    different one is acquired. Backs off first if the pool has no healthy endpoint left to switch to.
+    """
+    proxy_pool.record_failure(endpoint, error)
+    proxy_pool.release(endpoint)
+    next_endpoint = proxy_pool.acquire()
+    if next_endpoint is endpoint:
+        with timings.stage("retry_backoff"):
+            time.sleep(RETRY_DELAY_SECONDS)
+    logger.info(f"Egress {endpoint.name} was blocked. Retrying through {next_endpoint.name}.")
+    return next_endpoint
+
+def _fetch_and_cache_transcript(
+    video_id: str,
+    preferred_lang: Optional[str],
+    cache_key: str,
+    output_options: Dict[str, Any],
+    timings: RequestTimings,
+) -> Dict[str, Any]:
+    """
+    Fetches a transcript from YouTube, stores it in the caption cache and builds the caption response.
+    """
+    # Each request leaves through one egress (proxy or direct) chosen by the pool
+    proxy_pool = get_proxy_pool()
+    endpoint = proxy_pool.acquire()
     try:
         logger.info(f"Fetching transcript for video ID: {video_id} with preferred language: {preferred_lang}")
 
         if not preferred_lang: # Default behavior: use ASR language for priority
             logger.info(f"No preferred language specified. Attempting to find suitable transcript based on ASR language for video ID: {video_id}")
             try:
-                transcript_options = YouTubeTranscriptApi.list_transcripts(video_id)
-
-                # Find the original video language from ASR transcripts
-                asr_transcripts = [t for t in transcript_options if t.is_generated]
-                original_video_lang = None
-                if asr_transcripts:
-                    original_video_lang = asr_transcripts[0].language_code
-                    logger.info(f"Inferred original video language from ASR: {original_video_lang}")
-
+                # The tracks are listed inside the retry loop, so a blocked listing also moves to another egress
                 chosen_transcript = None
-                if original_video_lang:
-                    # Prioritize manually created (CC) transcripts in the original video language
-                    matching_cc_transcripts = [t for t in transcript_options if not t.is_generated and t.language_code == original_video_lang]
-                    if matching_cc_transcripts:
-                        chosen_transcript = matching_cc_transcripts[0] # Pick the first matching CC transcript
-                        logger.info(f"Selected manually created transcript in original video language: {chosen_transcript.language_code}")
-                    else:
-                        # If no matching CC transcript, use the ASR transcript in the original video language
-                        chosen_transcript = asr_transcripts[0] # This should exist if original_video_lang was determined
-                        logger.info(f"No matching CC transcript found. Selected ASR transcript in original video language: {chosen_transcript.language_code}")
-                else:
-                    # Fallback if no ASR transcripts are available (cannot determine original language)
-                    logger.warning(f"No ASR transcripts found for video ID: {video_id}. Falling back to general priority.")
-                    # Fallback logic: Prioritize 'en' CC, then first available CC, then 'en' ASR, then first available ASR
-                    cc_transcripts = [t for t in transcript_options if not t.is_generated]
-                    asr_transcripts_fallback = [t for t in transcript_options if t.is_generated] # Re-filter ASR for fallback
-
-                    en_cc = next((t for t in cc_transcripts if t.language_code == 'en'), None)
-                    if en_cc:
-                        chosen_transcript = en_cc
-                        logger.info(f"Fallback: Selected 'en' manually created transcript.")
-                    elif cc_transcripts:
-                        chosen_transcript = cc_transcripts[0]
-                        logger.info(f"Fallback: Selected first available manually created transcript: {chosen_transcript.language_code}")
-                    else:
-                        en_asr = next((t for t in asr_transcripts_fallback if t.language_code == 'en'), None)
-                        if en_asr:
-                            chosen_transcript = en_asr
-                            logger.info(f"Fallback: Selected 'en' auto-generated transcript.")
-                        elif asr_transcripts_fallback:
-                            chosen_transcript = asr_transcripts_fallback[0]
-                            logger.info(f"Fallback: Selected first available auto-generated transcript: {chosen_transcript.language_code}")
-
-
-                if chosen_transcript:
-                    for attempt in range(MAX_RETRIES):
-                        try:
+                for attempt in range(MAX_RETRIES):
+                    try:
+                        if chosen_transcript is None:
+                            # Transcripts are bound to the session that listed them, so each egress lists its own
+                            with timings.stage("track_listing"):
+                                transcript_options = endpoint.api.list(video_id)
+                            chosen_transcript = _choose_default_transcript(video_id, transcript_options)
+                            if chosen_transcript is None:
+                                # No usable transcripts found even after fallback
+                                warning_msg = f"No usable transcripts found for video: {video_id} after checking ASR language and fallback options."
+                                logger.warning(warning_msg)
+                                return {
+                                    "error": {
+                                        "message": warning_msg,
+                                        "code": "NO_USABLE_TRANSCRIPT_FOUND"
+                                    },
+                                    "available_languages": [t.language_code for t in transcript_options] if transcript_options else []
+                                }
+                        with timings.stage("body_download"):
                             transcript_list = chosen_transcript.fetch()
-                            languages_used = chosen_transcript.language_code # Use single string
-                            logger.info(f"Successfully fetched transcript for video ID: {video_id} with language: {languages_used} on attempt {attempt + 1}")
-
-                            captions = "\n".join([item.text for item in transcript_list])
-                            return {"captions": captions, "video_id": video_id, "language_codes_used": languages_used}
-                        except Exception as e:
-                            if attempt < MAX_RETRIES - 1:
-                                logger.warning(f"Attempt {attempt + 1} failed for video ID {video_id}: {e}. Retrying in {RETRY_DELAY_SECONDS} seconds...")
+                        proxy_pool.record_success(endpoint)
+                        languages_used = chosen_transcript.language_code # Use single string
+                        logger.info(f"Successfully fetched transcript for video ID: {video_id} with language: {languages_used} on attempt {attempt + 1}")
+
+                        with timings.stage("cache_store"):
+                            entry = _store_transcript(cache_key, transcript_list, languages_used, transcript_options)
+                        with timings.stage("formatting"):
+                            return _build_caption_response(entry, cache_key, video_id, output_options)
+                    except (TranscriptsDisabled, NoTranscriptFound):
+                        raise
+                    except Exception as e:
+                        if attempt < MAX_RETRIES - 1 and is_block_error(e):
+                            logger.warning(f"Attempt {attempt + 1} for video ID {video_id} was blocked: {e}. Switching egress...")
+                            endpoint = _switch_endpoint(proxy_pool, endpoint, e, timings)
+                            chosen_transcript = None
+                        elif attempt < MAX_RETRIES - 1 and chosen_transcript is not None:
+                            # Only body downloads are retried on the same egress; other listing errors are final
+                            logger.warning(f"Attempt {attempt + 1} failed for video ID {video_id}: {e}. Retrying in {RETRY_DELAY_SECONDS} seconds...")
+                            with timings.stage("retry_backoff"):
                                 time.sleep(RETRY_DELAY_SECONDS)
-                            else:
-                                logger.error(f"Failed to fetch transcript for video ID {video_id} after {MAX_RETRIES} attempts: {e}")
-                                raise e # Re-raise the exception to be caught by the outer handler
-                else:
-                     # No usable transcripts found even after fallback
-                     warning_msg = f"No usable transcripts found for video: {video_id} after checking ASR language and fallback options."
-                     logger.warning(warning_msg)
-                     return {
-                         "error": {
-                             "message": warning_msg,
-                             "code": "NO_USABLE_TRANSCRIPT_FOUND"
-                         },
-                         "available_languages": [t.language_code for t in transcript_options] if transcript_options else []
-                     }
+                        else:
+                            logger.error(f"Failed to fetch transcript for video ID {video_id} after {attempt + 1} attempts: {e}")
+                            raise e # Re-raise the exception to be caught by the outer handler
 
             except TranscriptsDisabled:
                 warning_msg = f"Transcripts are disabled for video: {video_id}"
@@ -148,6 +343,7 @@ def fetch_youtube_captions(
                      }
                  }
             except Exception as e_default:
+                 proxy_pool.record_failure(endpoint, e_default)
                  error_msg = f"An error occurred during default transcript fetching for video ID {video_id}: {str(e_default)}"
                  logger.error(error_msg)
                  return {"error": {"message": error_msg, "code": "DEFAULT_FETCH_ERROR"}}
@@ -155,22 +351,40 @@ def fetch_youtube_captions(
         else: # Try specified language code
             logger.info(f"Fetching transcript for video ID: {video_id} with specified language: {preferred_lang}")
             try:
-                # Use find_transcript to get a single transcript for the preferred language
-                transcript = YouTubeTranscriptApi.list_transcripts(video_id).find_transcript([preferred_lang])
+                # The tracks are listed inside the retry loop, so a blocked listing also moves to another egress
+                transcript = None
                 for attempt in range(MAX_RETRIES):
                     try:
-                        transcript_list = transcript.fetch()
+                        if transcript is None:
+                            # Transcripts are bound to the session that listed them, so each egress lists its own
+                            with timings.stage("track_listing"):
+                                transcript_options = endpoint.api.list(video_id)
+                            # Use find_transcript to get a single transcript for the preferred language
+                            transcript = transcript_options.find_transcript([preferred_lang])
+                        with timings.stage("body_download"):
+                            transcript_list = transcript.fetch()
+                        proxy_pool.record_success(endpoint)
                         languages_used = preferred_lang # Use single string
                         logger.info(f"Successfully fetched transcript for video ID: {video_id} with language: {languages_used} on attempt {attempt + 1}")
 
-                        captions = "\n".join([item.text for item in transcript_list])
-                        return {"captions": captions, "video_id": video_id, "language_codes_used": languages_used}
+                        with timings.stage("cache_store"):
+                            entry = _store_transcript(cache_key, transcript_list, languages_used, transcript_options)
+                        with timings.stage("formatting"):
+                            return _build_caption_response(entry, cache_key, video_id, output_options)
+                    except (TranscriptsDisabled, NoTranscriptFound):
+                        raise
                     except Exception as e:
-                        if attempt < MAX_RETRIES - 1:
+                        if attempt < MAX_RETRIES - 1 and is_block_error(e):
+                            logger.warning(f"Attempt {attempt + 1} for video ID {video_id} with language {preferred_lang} was blocked: {e}. Switching egress...")
+                            endpoint = _switch_endpoint(proxy_pool, endpoint, e, timings)
+                            transcript = None
+                        elif attempt < MAX_RETRIES - 1 and transcript is not None:
+                            # Only body downloads are retried on the same egress; other listing errors are final
                             logger.warning(f"Attempt {attempt + 1} failed for video ID {video_id} with language {preferred_lang}: {e}. Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                            time.sleep(RETRY_DELAY_SECONDS)
+                            with timings.stage("retry_backoff"):
+                                time.sleep(RETRY_DELAY_SECONDS)
                         else:
-                            logger.error(f"Failed to fetch transcript for video ID {video_id} with language {preferred_lang} after {MAX_RETRIES} attempts: {e}")
+                            logger.error(f"Failed to fetch transcript for video ID {video_id} with language {preferred_lang} after {attempt + 1} attempts: {e}")
                             raise e # Re-raise the exception to be caught by the outer handler
 
             except TranscriptsDisabled:
@@ -184,7 +398,8 @@ def fetch_youtube_captions(
                 # We should return an error indicating this, possibly listing available languages.
                 available_transcripts = []
                 try:
-                     transcript_options = YouTubeTranscriptApi.list_transcripts(video_id)
+                     with timings.stage("track_listing"):
+                         transcript_options = endpoint.api.list(video_id)
                      available_transcripts = [t.language_code for t in transcript_options]
                      logger.info(f"Available transcripts for video ID {video_id}: {available_transcripts}")
                 except Exception as e_list:
@@ -200,6 +415,7 @@ def fetch_youtube_captions(
                     "available_languages": available_transcripts if available_transcripts else "Could not retrieve available languages."
                 }
             except Exception as e_specified:
+                proxy_pool.record_failure(endpoint, e_specified)
                 error_msg = f"An error occurred while fetching transcript for specified language {preferred_lang} for video ID {video_id}: {str(e_specified)}"
                 logger.error(error_msg)
                 return {"error": {"message": error_msg, "code": "SPECIFIED_FETCH_ERROR"}}
@@ -207,4 +423,7 @@ def fetch_youtube_captions(
     except Exception as e:
         error_msg = f"An unexpected error occurred: {str(e)}"
         logger.error(f"An unexpected error occurred for video ID {video_id}: {str(e)}")
-        return {"error": {"message": error_msg, "code": "UNEXPECTED_ERROR"}}
\ No newline at end of file
+        proxy_pool.record_failure(endpoint, e)
+        return {"error": {"message": error_msg, "code": "UNEXPECTED_ERROR"}}
+    finally:
+        proxy_pool.release(endpoint)
@@ -0,0 +1,96 @@
+import time
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from src.caption_cache import MemoryCache, DiskCache, RedisCache, create_cache_from_env
+
+
+class FakeRedis:
+    """Local stand-in for a Redis-compatible server, implementing the subset of commands the cache uses."""
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        entry = self.store.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1].encode()
+
+    def set(self, key, value, ex=None):
+        self.store[key] = (time.time() + ex if ex else float("inf"), value)
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+class TestCaptionCache(unittest.TestCase):
+
+    def test_memory_cache_roundtrip_and_expiry(self):
+        """Test that the in-memory cache returns stored values until they expire."""
+        cache = MemoryCache()
+        cache.set("youtube:abc:auto", {"segments": []})
+        self.assertEqual(cache.get("youtube:abc:auto"), {"segments": []})
+
+        cache.set("youtube:abc:en", {"segments": []}, ttl_seconds=-1)
+        self.assertIsNone(cache.get("youtube:abc:en"))
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        """Test that the in-memory cache stays within max_entries by evicting the least recently used entry."""
+        cache = MemoryCache(max_entries=2)
+        cache.set("a", {"n": 1})
+        cache.set("b", {"n": 2})
+        cache.get("a")
+        cache.set("c", {"n": 3})
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"n": 1})
+        self.assertEqual(cache.get("c"), {"n": 3})
+
+    def test_disk_cache_purges_expired_rows_on_write(self):
+        """Test that writes periodically delete expired rows that are never read again."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir)
+            cache.set("expired", {"n": 1}, ttl_seconds=-1)
+            cache._last_purge = 0.0
+            cache.set("fresh", {"n": 2})
+
+            keys = [row[0] for row in cache._connect().execute("SELECT key FROM captions")]
+            self.assertEqual(keys, ["fresh"])
+
+    def test_disk_cache_is_shared_between_instances(self):
+        """Test that two disk caches on the same directory (as in two workers) see each other's entries."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            writer = DiskCache(cache_dir)
+            reader = DiskCache(cache_dir)
+            writer.set("bilibili:BV1xx411c7mY:1:zh-CN", {"body": [{"content": "你好"}], "lang": "zh-CN"})
+
+            self.assertEqual(reader.get("bilibili:BV1xx411c7mY:1:zh-CN")["body"][0]["content"], "你好")
+
+            writer.delete("bilibili:BV1xx411c7mY:1:zh-CN")
+            self.assertIsNone(reader.get("bilibili:BV1xx411c7mY:1:zh-CN"))
+
+    def test_redis_cache_with_local_stand_in(self):
+        """Test the Redis backend against a local stand-in client."""
+        client = FakeRedis()
+        cache = RedisCache(client, ttl_seconds=60)
+        cache.set("youtube:abc:auto", {"language_codes_used": "en"})
+
+        self.assertIn("caption-fetcher:youtube:abc:auto", client.store)
+        self.assertEqual(cache.get("youtube:abc:auto"), {"language_codes_used": "en"})
+        self.assertIsNone(cache.get("youtube:missing:auto"))
+
+    def test_create_cache_from_env(self):
+        """Test backend selection through the CACHE_BACKEND environment variable."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict("os.environ", {"CACHE_BACKEND": "disk", "CACHE_DIR": cache_dir}):
+                self.assertIsInstance(create_cache_from_env(), DiskCache)
+        with patch.dict("os.environ", {"CACHE_BACKEND": "none"}):
+            self.assertIsNone(create_cache_from_env())
+        with patch.dict("os.environ", {}, clear=True):
+            self.assertIsInstance(create_cache_from_env(), MemoryCache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from src.caption_cache import MemoryCache, get_cache, set_cache
+from src.caption_chunker import chunk_segments, estimate_size, get_or_build_chunks
+from src.youtube_fetcher import fetch_youtube_captions
+
+
+def make_segments(count, text="hello world", seconds=2.0):
+    return [{"start": i * seconds, "end": (i + 1) * seconds, "text": f"{text} {i}"} for i in range(count)]
+
+
+class TestCaptionChunker(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(set_cache, get_cache())
+        set_cache(MemoryCache())
+
+    def test_chunks_fit_budget_and_break_between_segments(self):
+        """Test that chunks respect the budget and keep whole segments with their timestamps."""
+        segments = make_segments(20)
+        chunks = chunk_segments(segments, budget=50, unit="chars")
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk["text"]), 50)
+            self.assertEqual(chunk["size"], len(chunk["text"]))
+        self.assertEqual("\n".join(chunk["text"] for chunk in chunks), "\n".join(s["text"] for s in segments))
+        self.assertEqual(chunks[0]["start"], 0.0)
+        self.assertEqual(chunks[-1]["end"], 40.0)
+        self.assertEqual([chunk["index"] for chunk in chunks], list(range(len(chunks))))
+
+    def test_oversized_segment_splits_on_sentences(self):
+        """Test that a segment larger than the budget is split on sentence edges with interpolated timestamps."""
+        segments = [{"start": 0.0, "end": 10.0, "text": "First sentence here. Second one follows. Third ends it."}]
+        chunks = chunk_segments(segments, budget=25, unit="chars")
+
+        self.assertEqual([chunk["text"] for chunk in chunks], ["First sentence here.", "Second one follows.", "Third ends it."])
+        self.assertEqual(chunks[0]["start"], 0.0)
+        self.assertEqual(chunks[-1]["end"], 10.0)
+        self.assertLessEqual(chunks[0]["end"], chunks[1]["start"])
+        self.assertGreater(chunks[0]["end"], chunks[0]["start"])
+
+    def test_token_budget(self):
+        """Test the token estimate: CJK characters count as one token, other text as a quarter each."""
+        self.assertEqual(estimate_size("abcdefgh", "tokens"), 2)
+        self.assertEqual(estimate_size("你好世界", "tokens"), 4)
+
+        chunks = chunk_segments([{"start": 0.0, "end": 4.0, "text": "你好世界你好世界"}], budget=3, unit="tokens")
+        for chunk in chunks:
+            self.assertLessEqual(chunk["size"], 3)
+        self.assertEqual("".join(chunk["text"] for chunk in chunks), "你好世界你好世界")
+
+    def test_split_keeps_decimals_urls_and_separators(self):
+        """Test that periods inside numbers and URLs don't end a sentence, and split pieces keep their separators."""
+        text = "We measured about 3.14159 units today. See example.com for the details! Then we stopped."
+        chunks = chunk_segments([{"start": 0.0, "end": 10.0, "text": text}], budget=40, unit="chars")
+
+        self.assertEqual(
+            [chunk["text"] for chunk in chunks],
+            ["We measured about 3.14159 units today.", "See example.com for the details!", "Then we stopped."],
+        )
+        self.assertEqual(" ".join(chunk["text"] for chunk in chunks), text)
+
+        # Pieces of one segment that share a chunk are joined with their original separator, not a newline
+        chunks = chunk_segments([{"start": 0.0, "end": 10.0, "text": "Aaa bbb. Ccc ddd. Eee fff."}], budget=18, unit="chars")
+        self.assertEqual([chunk["text"] for chunk in chunks], ["Aaa bbb. Ccc ddd.", "Eee fff."])
+
+    def test_invalid_budget(self):
+        """Test that a budget below one is rejected."""
+        with self.assertRaises(ValueError):
+            chunk_segments(make_segments(1), budget=0)
+
+    def test_chunks_are_memoized_per_version_and_budget(self):
+        """Test that chunks are computed once per transcript version and budget."""
+        segments = make_segments(10)
+
+        with patch("src.caption_chunker.chunk_segments", wraps=chunk_segments) as mock_chunk:
+            first, _ = get_or_build_chunks("youtube:abc:auto", "v1", segments, 40, "chars", False)
+            second, _ = get_or_build_chunks("youtube:abc:auto", "v1", segments, 40, "chars", False)
+            self.assertEqual(first, second)
+            self.assertEqual(mock_chunk.call_count, 1)
+
+            get_or_build_chunks("youtube:abc:auto", "v1", segments, 80, "chars", False)
+            get_or_build_chunks("youtube:abc:auto", "v2", segments, 40, "chars", False)
+            self.assertEqual(mock_chunk.call_count, 3)
+
+    def test_youtube_chunks_output_mode(self):
+        """Test that the YouTube fetcher returns chunks instead of the joined captions in chunks mode."""
+        get_cache().set("youtube:dQw4w9WgXcQ:auto", {
+            "segments": make_segments(10),
+            "language_codes_used": "en",
+            "version": "v1",
+            "fetched_at": time.time(),
+        })
+
+        result = fetch_youtube_captions(
+            "https://www.youtube.com/watch?v=dQw4w9WgXcQ", output_mode="chunks", chunk_budget=30, budget_unit="chars"
+        )
+        self.assertNotIn("captions", result)
+        self.assertEqual(result["video_id"], "dQw4w9WgXcQ")
+        self.assertTrue(all(chunk["size"] <= 30 for chunk in result["chunks"]))
+
+        result = fetch_youtube_captions("https://www.youtube.com/watch?v=dQw4w9WgXcQ", output_mode="chunks", chunk_budget=0)
+        self.assertEqual(result["error"]["code"], "INVALID_CHUNK_BUDGET")
+
+
+if __name__ == '__main__':
+    unittest.main()
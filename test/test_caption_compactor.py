@@ -0,0 +1,86 @@
+import unittest
+
+from src.caption_compactor import compact_segments, normalize_caption_text
+
+
+class TestCaptionCompactor(unittest.TestCase):
+
+    def test_normalize_caption_text(self):
+        """Test that markup, entities and extra whitespace are removed."""
+        self.assertEqual(normalize_caption_text("<font color='#fff'>hello</font>\n  &amp;   world "), "hello & world")
+
+    def test_rolling_repeats_are_removed(self):
+        """Test that rolling ASR fragments repeating the previous segment are deduplicated."""
+        segments = [
+            {"start": 0.0, "end": 2.0, "text": "so today we are"},
+            {"start": 2.0, "end": 4.0, "text": "today we are going to talk"},
+            {"start": 4.0, "end": 6.0, "text": "going to talk"},
+            {"start": 6.0, "end": 8.0, "text": "about caching."},
+        ]
+        compacted, stats = compact_segments(segments)
+
+        self.assertEqual(len(compacted), 1)
+        self.assertEqual(compacted[0]["text"], "so today we are going to talk about caching.")
+        self.assertEqual(compacted[0]["start"], 0.0)
+        self.assertEqual(compacted[0]["end"], 8.0)
+        self.assertEqual(stats["duplicates_removed"], 1)
+        self.assertLess(stats["compacted_chars"], stats["original_chars"])
+
+    def test_partial_word_overlap_is_kept(self):
+        """Test that an overlap ending inside a word is not treated as a repeat."""
+        segments = [
+            {"start": 0.0, "end": 1.0, "text": "look over there"},
+            {"start": 1.0, "end": 2.0, "text": "therefore it works"},
+        ]
+        compacted, _ = compact_segments(segments)
+        self.assertEqual(compacted[0]["text"], "look over there therefore it works")
+
+    def test_short_trailing_segments_are_kept(self):
+        """Test that short segments matching the end of the previous one are not dropped as repeats."""
+        cases = [
+            ("the kitten", "ten"),
+            ("I said no", "no"),
+            ("你好", "好"),
+            ("we are going to win", "to win"),
+        ]
+        for previous, current in cases:
+            segments = [
+                {"start": 0.0, "end": 1.0, "text": previous},
+                {"start": 1.0, "end": 2.0, "text": current},
+            ]
+            compacted, stats = compact_segments(segments)
+            self.assertTrue(compacted[0]["text"].endswith(current), (previous, current))
+            self.assertEqual(stats["duplicates_removed"], 0)
+
+    def test_repeats_extend_block_and_empty_segments_are_not_duplicates(self):
+        """Test that dropped repeats extend the block's end, and markup-only segments aren't counted as repeats."""
+        segments = [{"start": float(i), "end": i + 1.0, "text": "the same caption line"} for i in range(5)]
+        segments.insert(2, {"start": 2.0, "end": 2.0, "text": "<i></i>"})
+        compacted, stats = compact_segments(segments)
+
+        self.assertEqual(len(compacted), 1)
+        self.assertEqual((compacted[0]["start"], compacted[0]["end"]), (0.0, 5.0))
+        self.assertEqual(stats["duplicates_removed"], 4)
+
+    def test_blocks_respect_max_duration(self):
+        """Test that merged blocks don't grow past the target duration."""
+        segments = [{"start": i * 4.0, "end": i * 4.0 + 4.0, "text": f"word{i}"} for i in range(10)]
+        compacted, stats = compact_segments(segments, max_block_seconds=10.0)
+
+        self.assertEqual(stats["compacted_segments"], len(compacted))
+        for block in compacted:
+            self.assertLessEqual(block["end"] - block["start"], 10.0)
+        self.assertEqual(" ".join(block["text"] for block in compacted), " ".join(f"word{i}" for i in range(10)))
+
+    def test_cjk_fragments_are_joined_without_spaces(self):
+        """Test that CJK fragments are concatenated directly."""
+        segments = [
+            {"start": 0.0, "end": 1.0, "text": "大家好"},
+            {"start": 1.0, "end": 2.0, "text": "欢迎来到频道"},
+        ]
+        compacted, _ = compact_segments(segments)
+        self.assertEqual(compacted[0]["text"], "大家好欢迎来到频道")
+
+
+if __name__ == '__main__':
+    unittest.main()
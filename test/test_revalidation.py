@@ -0,0 +1,163 @@
+import time
+import asyncio
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import httpx
+
+from src import bilibili_fetcher, youtube_fetcher
+from src.caption_cache import MemoryCache, get_cache, set_cache, begin_refresh, end_refresh
+from src.proxy_pool import ProxyPool
+
+BILIBILI_URL = "https://www.bilibili.com/video/BV1xx411c7mY/"
+SUBTITLE_BODY = {"body": [{"from": 0.0, "to": 1.0, "content": "你好"}]}
+
+
+def make_bilibili_video():
+    v = MagicMock()
+    v.get_info = AsyncMock(return_value={"cid": 123})
+    v.get_subtitle = AsyncMock(return_value={"subtitles": [
+        {"lan": "zh-CN", "id_str": "987", "ai_type": 0, "subtitle_url": "//aisubtitle.hdslb.com/bfs/subtitle/987.json"},
+    ]})
+    return v
+
+
+class TestBilibiliRevalidation(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.addCleanup(set_cache, get_cache())
+        set_cache(MemoryCache())
+        self.requests = []
+
+        def handler(request):
+            self.requests.append(request)
+            if request.headers.get("If-None-Match") == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, json=SUBTITLE_BODY, headers={"ETag": '"v1"'})
+
+        real_client = httpx.AsyncClient
+        patchers = [
+            patch("src.bilibili_fetcher.video.Video", side_effect=lambda **kwargs: make_bilibili_video()),
+            patch("httpx.AsyncClient", side_effect=lambda **kwargs: real_client(transport=httpx.MockTransport(handler))),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def test_stale_entry_is_served_and_revalidated_conditionally(self):
+        """Test that a stale hit returns immediately and revalidates with If-None-Match in the background."""
+        first = await bilibili_fetcher.fetch_bilibili_subtitle(BILIBILI_URL)
+        self.assertEqual(first, "你好")
+        self.assertEqual(len(self.requests), 1)
+
+        with patch.dict("os.environ", {"CACHE_FRESH_SECONDS": "0"}):
+            second = await bilibili_fetcher.fetch_bilibili_subtitle(BILIBILI_URL)
+            self.assertEqual(second, "你好")
+            await asyncio.gather(*bilibili_fetcher._background_tasks)
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].headers["If-None-Match"], '"v1"')
+        self.assertEqual(self.requests[1].headers["Referer"], "https://www.bilibili.com/video/BV1xx411c7mY/")
+
+    async def test_fresh_entry_does_not_revalidate(self):
+        """Test that fresh cache hits don't touch upstream."""
+        await bilibili_fetcher.fetch_bilibili_subtitle(BILIBILI_URL)
+        await bilibili_fetcher.fetch_bilibili_subtitle(BILIBILI_URL, output_format="timestamped")
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(bilibili_fetcher._background_tasks), 0)
+
+
+class FakeTrack:
+    def __init__(self, language_code, is_generated):
+        self.language_code = language_code
+        self.is_generated = is_generated
+
+
+class TestYoutubeRevalidation(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MemoryCache()
+        self.addCleanup(set_cache, get_cache())
+        set_cache(self.cache)
+        self.api = MagicMock()
+        self.api.list.return_value = [FakeTrack("en", True), FakeTrack("en", False)]
+        self.pool = ProxyPool([], api_factory=lambda url: self.api)
+        pool_patcher = patch("src.youtube_fetcher.get_proxy_pool", return_value=self.pool)
+        pool_patcher.start()
+        self.addCleanup(pool_patcher.stop)
+
+    def test_unchanged_tracks_keep_cached_transcript(self):
+        """Test that revalidation only lists tracks when nothing changed."""
+        cached = {"segments": [{"start": 0.0, "end": 1.0, "text": "hi"}], "language_codes_used": "en",
+                  "tracks": [["en", False], ["en", True]], "fetched_at": 0, "body_fetched_at": time.time()}
+        begin_refresh("youtube:abcdefghijk:auto")
+
+        with patch("src.youtube_fetcher._fetch_and_cache_transcript") as mock_fetch:
+            youtube_fetcher._refresh_transcript("abcdefghijk", None, "youtube:abcdefghijk:auto", cached)
+
+        mock_fetch.assert_not_called()
+        stored = self.cache.get("youtube:abcdefghijk:auto")
+        self.assertGreater(stored["fetched_at"], 0)
+        self.assertEqual(stored["body_fetched_at"], cached["body_fetched_at"])
+        # The refresh claim is released so the next stale hit can refresh again
+        self.assertTrue(begin_refresh("youtube:abcdefghijk:auto"))
+        end_refresh("youtube:abcdefghijk:auto")
+
+    def test_changed_tracks_refetch_transcript(self):
+        """Test that a changed track listing triggers a full refetch."""
+        cached = {"segments": [], "language_codes_used": "en", "tracks": [["en", True]], "fetched_at": 0}
+        begin_refresh("youtube:abcdefghijk:auto")
+
+        with patch("src.youtube_fetcher._fetch_and_cache_transcript", return_value={"captions": ""}) as mock_fetch:
+            youtube_fetcher._refresh_transcript("abcdefghijk", None, "youtube:abcdefghijk:auto", cached)
+
+        mock_fetch.assert_called_once()
+        self.assertEqual(mock_fetch.call_args.args, ("abcdefghijk", None, "youtube:abcdefghijk:auto"))
+        self.assertEqual(mock_fetch.call_args.kwargs["output_options"], {})
+
+    def test_body_older_than_ttl_is_refetched(self):
+        """Test that an unchanged track listing doesn't keep a transcript body past the cache TTL."""
+        body_fetched_at = time.time() - self.cache.ttl_seconds - 1
+        cached = {"segments": [], "language_codes_used": "en", "tracks": [["en", False], ["en", True]],
+                  "fetched_at": time.time(), "body_fetched_at": body_fetched_at}
+        begin_refresh("youtube:abcdefghijk:auto")
+
+        with patch("src.youtube_fetcher._fetch_and_cache_transcript", return_value={"captions": ""}) as mock_fetch:
+            youtube_fetcher._refresh_transcript("abcdefghijk", None, "youtube:abcdefghijk:auto", cached)
+
+        mock_fetch.assert_called_once()
+
+    def test_failed_refresh_backs_off(self):
+        """Test that a failed background refresh stops stale hits from refreshing the key again right away."""
+        self.api.list.side_effect = ConnectionError("upstream down")
+        cached = {"segments": [], "language_codes_used": "en", "tracks": [], "fetched_at": 0}
+        self.assertTrue(begin_refresh("youtube:abcdefghijk:auto"))
+
+        youtube_fetcher._refresh_transcript("abcdefghijk", None, "youtube:abcdefghijk:auto", cached)
+
+        self.assertFalse(begin_refresh("youtube:abcdefghijk:auto"))
+
+    def test_unchanged_tracks_keep_newer_entry_from_other_worker(self):
+        """Test that revalidation doesn't overwrite an entry another worker replaced in the meantime."""
+        cached = {"segments": [], "language_codes_used": "en", "tracks": [["en", False], ["en", True]],
+                  "version": "v1", "fetched_at": 0, "body_fetched_at": time.time()}
+        self.cache.set("youtube:abcdefghijk:auto", {**cached, "version": "v2", "fetched_at": 1})
+        begin_refresh("youtube:abcdefghijk:auto")
+
+        youtube_fetcher._refresh_transcript("abcdefghijk", None, "youtube:abcdefghijk:auto", cached)
+
+        stored = self.cache.get("youtube:abcdefghijk:auto")
+        self.assertEqual((stored["version"], stored["fetched_at"]), ("v2", 1))
+
+    def test_concurrent_refreshes_are_coalesced(self):
+        """Test that only one background refresh per key runs at a time."""
+        self.assertTrue(begin_refresh("youtube:zzzzzzzzzzz:auto"))
+        self.assertFalse(begin_refresh("youtube:zzzzzzzzzzz:auto"))
+        end_refresh("youtube:zzzzzzzzzzz:auto")
+        self.assertTrue(begin_refresh("youtube:zzzzzzzzzzz:auto"))
+        end_refresh("youtube:zzzzzzzzzzz:auto")
+
+
+if __name__ == '__main__':
+    unittest.main()
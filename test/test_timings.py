@@ -0,0 +1,113 @@
+import os
+import asyncio
+import time
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from src import server
+from src.caption_cache import MemoryCache, get_cache, set_cache
+from src.profiling import profile_request
+from src.timings import RequestTimings
+from src.youtube_fetcher import fetch_youtube_captions
+from src.bilibili_fetcher import fetch_bilibili_subtitle
+
+
+def busy_wait(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+class TestRequestTimings(unittest.TestCase):
+
+    def test_repeated_stages_accumulate(self):
+        """Test that a stage entered several times reports the total time."""
+        timings = RequestTimings()
+        timings.add("retry_backoff", 0.5)
+        timings.add("retry_backoff", 0.25)
+        with timings.stage("url_parse"):
+            pass
+
+        result = timings.to_dict()
+        self.assertEqual(result["stages_ms"]["retry_backoff"], 750.0)
+        self.assertIn("url_parse", result["stages_ms"])
+        self.assertGreaterEqual(result["total_ms"], 0)
+
+    def test_youtube_debug_timings_from_cache(self):
+        """Test that debug_timings adds a stage breakdown to a cached YouTube response."""
+        cache = MemoryCache()
+        self.addCleanup(set_cache, get_cache())
+        set_cache(cache)
+        cache.set("youtube:dQw4w9WgXcQ:auto", {
+            "segments": [{"start": 0.0, "end": 1.0, "text": "hello"}],
+            "language_codes_used": "en",
+            "fetched_at": time.time(),
+        })
+
+        result = fetch_youtube_captions("https://www.youtube.com/watch?v=dQw4w9WgXcQ", debug_timings=True)
+        self.assertEqual(result["captions"], "hello")
+        self.assertEqual(set(result["timings"]["stages_ms"]), {"url_parse", "cache_lookup", "formatting"})
+
+        self.assertNotIn("timings", fetch_youtube_captions("https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+
+    def test_bilibili_error_is_not_wrapped_as_captions(self):
+        """Test that an error message is returned under 'error', not 'captions', when debug_timings is enabled."""
+        result = asyncio.run(fetch_bilibili_subtitle("https://www.bilibili.com/", debug_timings=True))
+        self.assertNotIn("captions", result)
+        self.assertTrue(result["error"].startswith("Error:"))
+        self.assertIn("url_parse", result["timings"]["stages_ms"])
+
+        result = asyncio.run(fetch_bilibili_subtitle(
+            "https://www.bilibili.com/video/BV1xx411c7mY/", debug_timings=True, output_mode="chunks", chunk_budget=0
+        ))
+        self.assertTrue(result["error"].startswith("Error: Invalid chunk budget"))
+        self.assertIn("timings", result)
+
+        result = fetch_youtube_captions(
+            "https://www.youtube.com/watch?v=dQw4w9WgXcQ", debug_timings=True, output_mode="chunks", chunk_budget=0
+        )
+        self.assertEqual(result["error"]["code"], "INVALID_CHUNK_BUDGET")
+        self.assertIn("timings", result)
+
+    def test_serialization_timing_added_by_server(self):
+        """Test that the tool handler adds the serialization stage to a timing breakdown."""
+        result = server._add_serialization_timing({"captions": "x", "timings": {"total_ms": 1.0, "stages_ms": {}}})
+        self.assertIn("serialization", result["timings"]["stages_ms"])
+        self.assertGreaterEqual(result["timings"]["total_ms"], 1.0 + result["timings"]["stages_ms"]["serialization"] - 0.001)
+        self.assertEqual(server._add_serialization_timing("plain"), "plain")
+
+
+class TestProfileRequest(unittest.TestCase):
+
+    def test_slow_request_writes_folded_stacks(self):
+        """Test that requests over the threshold dump flame-graph-compatible stacks."""
+        with tempfile.TemporaryDirectory() as profile_dir:
+            env = {"PROFILE_THRESHOLD_MS": "20", "PROFILE_INTERVAL_MS": "1", "PROFILE_DIR": profile_dir}
+            with patch.dict("os.environ", env):
+                with profile_request("fast_request"):
+                    pass
+                with profile_request("slow_request"):
+                    busy_wait(0.1)
+
+            files = os.listdir(profile_dir)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].startswith("slow_request-"))
+            with open(os.path.join(profile_dir, files[0]), encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines)
+            stack, count = lines[0].rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+            self.assertTrue(any("busy_wait" in line for line in lines))
+
+    def test_disabled_without_threshold(self):
+        """Test that profiling is a no-op unless PROFILE_THRESHOLD_MS is set."""
+        with patch.dict("os.environ", {}, clear=True):
+            with patch("src.profiling.SamplingProfiler") as mock_profiler:
+                with profile_request("request"):
+                    pass
+        mock_profiler.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()